@@ -2,11 +2,32 @@
 Сайт Gleeful.ru
 """
 
-from flask import Flask, render_template, request, redirect, url_for, flash, abort, session, jsonify
+from flask import Flask, render_template, request, redirect, url_for, flash, abort, session, jsonify, make_response, g, \
+    Response, stream_with_context, has_request_context
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import and_, or_, text, func, select, insert, delete, union_all, literal_column, event
+from markupsafe import Markup, escape
+from sqlalchemy.engine import Engine, Row
+from sqlalchemy.schema import CreateTable
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta, timezone
+from collections import namedtuple, OrderedDict, defaultdict
+from decimal import Decimal
+from functools import wraps
+import base64
+import click
+import csv
+import hashlib
+import io
+import json
+import logging
+import re
+import sqlite3
+import threading
+import time
 import os
 
 app = Flask(__name__)
@@ -16,18 +37,124 @@ basedir = os.path.abspath(os.path.dirname(__file__))
 app.config['SECRET_KEY'] = '7a3f9e2c8b4d1f6e5a9c3b7d2f8e4a1b6c5d9f3e7a2b8c4d1f6e5a9c3b7d2f8e'
 
 db_path = os.environ.get('DATABASE_PATH', os.path.join(basedir, 'instance', 'party_agency.db'))
-app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{db_path}'
+database_url = os.environ.get('DATABASE_URL', f'sqlite:///{db_path}')
+if database_url.startswith('postgres://'):
+    database_url = 'postgresql://' + database_url[len('postgres://'):]
+app.config['SQLALCHEMY_DATABASE_URI'] = database_url
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+if not database_url.startswith('sqlite'):
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        'pool_size': int(os.environ.get('DB_POOL_SIZE', 10)),
+        'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 20)),
+        'pool_timeout': int(os.environ.get('DB_POOL_TIMEOUT', 30)),
+        'pool_recycle': int(os.environ.get('DB_POOL_RECYCLE', 1800)),
+        'pool_pre_ping': os.environ.get('DB_POOL_PRE_PING', '1') == '1',
+    }
+app.config['CATALOG_CACHE_TTL'] = int(os.environ.get('CATALOG_CACHE_TTL', 300))
+app.config['PUBLIC_CACHE_MAX_AGE'] = int(os.environ.get('PUBLIC_CACHE_MAX_AGE', 60))
+app.config['RESPONSE_CACHE_ENABLED'] = os.environ.get('RESPONSE_CACHE_ENABLED', '0') == '1'
+app.config['RESPONSE_CACHE_MAX_ENTRIES'] = int(os.environ.get('RESPONSE_CACHE_MAX_ENTRIES', 512))
+app.config['RESPONSE_CACHE_TTL'] = int(os.environ.get('RESPONSE_CACHE_TTL', 300))
+app.config['STATS_RECONCILE_INTERVAL'] = int(os.environ.get('STATS_RECONCILE_INTERVAL', 3600))
+app.config['ANALYTICS_REFRESH_INTERVAL'] = int(os.environ.get('ANALYTICS_REFRESH_INTERVAL', 300))
+app.config['CALENDAR_CACHE_TTL'] = int(os.environ.get('CALENDAR_CACHE_TTL', 60))
+app.config['DAILY_EVENT_CAPACITY'] = int(os.environ.get('DAILY_EVENT_CAPACITY', 0))
+app.config['CAPACITY_POLICY'] = os.environ.get('CAPACITY_POLICY', 'warn')
+app.config['ORDER_EVENTS_POLL_INTERVAL'] = int(os.environ.get('ORDER_EVENTS_POLL_INTERVAL', 5))
+app.config['ORDER_EVENTS_STREAM_DURATION'] = int(os.environ.get('ORDER_EVENTS_STREAM_DURATION', 300))
+app.config['ORDER_ARCHIVE_AFTER_DAYS'] = int(os.environ.get('ORDER_ARCHIVE_AFTER_DAYS', 180))
+app.config['SQLITE_JOURNAL_MODE'] = os.environ.get('SQLITE_JOURNAL_MODE', 'WAL')
+app.config['SQLITE_SYNCHRONOUS'] = os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL')
+app.config['SQLITE_BUSY_TIMEOUT'] = int(os.environ.get('SQLITE_BUSY_TIMEOUT', 5000))
+app.config['SQLITE_MMAP_SIZE'] = int(os.environ.get('SQLITE_MMAP_SIZE', 256 * 1024 * 1024))
+app.config['SQLITE_CACHE_SIZE'] = int(os.environ.get('SQLITE_CACHE_SIZE', -64000))
+app.config['SQLITE_TEMP_STORE'] = os.environ.get('SQLITE_TEMP_STORE', 'MEMORY')
+app.config['SQL_INSTRUMENTATION'] = os.environ.get('SQL_INSTRUMENTATION', '0') == '1'
+app.config['SQL_SLOW_QUERY_MS'] = int(os.environ.get('SQL_SLOW_QUERY_MS', 100))
+app.config['SQL_SLOW_QUERY_LOG'] = os.environ.get('SQL_SLOW_QUERY_LOG')
+app.config['SQL_N_PLUS_ONE_THRESHOLD'] = int(os.environ.get('SQL_N_PLUS_ONE_THRESHOLD', 5))
+
+SQLITE_JOURNAL_MODES = ('DELETE', 'TRUNCATE', 'PERSIST', 'MEMORY', 'WAL', 'OFF')
+SQLITE_SYNCHRONOUS_MODES = ('OFF', 'NORMAL', 'FULL', 'EXTRA')
+SQLITE_TEMP_STORES = ('DEFAULT', 'FILE', 'MEMORY')
+
+def sqlite_pragmas():
+    """
+    Профиль соединения SQLite из конфигурации в виде списка (pragma, значение).
+
+    Значения PRAGMA нельзя передать параметрами запроса, поэтому строковые
+    настройки проверяются по списку допустимых, а числовые приводятся к int.
+    """
+    journal_mode = app.config['SQLITE_JOURNAL_MODE'].upper()
+    synchronous = app.config['SQLITE_SYNCHRONOUS'].upper()
+    temp_store = app.config['SQLITE_TEMP_STORE'].upper()
+    if journal_mode not in SQLITE_JOURNAL_MODES:
+        raise ValueError(f'Недопустимый SQLITE_JOURNAL_MODE: {journal_mode}')
+    if synchronous not in SQLITE_SYNCHRONOUS_MODES:
+        raise ValueError(f'Недопустимый SQLITE_SYNCHRONOUS: {synchronous}')
+    if temp_store not in SQLITE_TEMP_STORES:
+        raise ValueError(f'Недопустимый SQLITE_TEMP_STORE: {temp_store}')
+
+    return [
+        ('busy_timeout', int(app.config['SQLITE_BUSY_TIMEOUT'])),
+        ('journal_mode', journal_mode),
+        ('synchronous', synchronous),
+        ('mmap_size', int(app.config['SQLITE_MMAP_SIZE'])),
+        ('cache_size', int(app.config['SQLITE_CACHE_SIZE'])),
+        ('temp_store', temp_store),
+    ]
+
+@event.listens_for(Engine, 'connect')
+def apply_sqlite_pragmas(dbapi_connection, connection_record):
+    """
+    Применяет профиль SQLite к каждому новому соединению пула.
+
+    WAL позволяет читателям не ждать запись оформления заказа, а busy_timeout
+    заставляет конкурирующих писателей из разных воркеров ждать блокировку
+    вместо немедленной ошибки «database is locked».
+    """
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+
+    cursor = dbapi_connection.cursor()
+    try:
+        for pragma, value in sqlite_pragmas():
+            cursor.execute(f'PRAGMA {pragma} = {value}')
+    finally:
+        cursor.close()
 
-@app.context_processor
-def inject_cart_count():
+def sqlite_settings_report():
     """
-    Контекст-процессор для передачи количества товаров в корзине во все шаблоны.
+    Фактические значения PRAGMA на соединении приложения.
 
+    Возвращает пустой словарь, если база не SQLite.
     """
-    return dict(cart_count=get_cart_count())
+    if db.engine.dialect.name != 'sqlite':
+        return {}
+
+    with db.engine.connect() as connection:
+        return {
+            pragma: connection.exec_driver_sql(f'PRAGMA {pragma}').scalar()
+            for pragma, _ in sqlite_pragmas()
+        }
 
 db = SQLAlchemy(app)
+
+def is_postgresql():
+    """
+    True, если приложение работает с PostgreSQL, а не с файлом SQLite.
+    """
+    return db.engine.dialect.name == 'postgresql'
+
+def upsert(model):
+    """
+    INSERT с поддержкой ON CONFLICT для текущей базы.
+
+    У вставок SQLite и PostgreSQL одинаковые on_conflict_do_nothing
+    и on_conflict_do_update, поэтому вызывающему коду диалект не важен.
+    """
+    return (postgresql_insert if is_postgresql() else sqlite_insert)(model)
+
 login_manager = LoginManager(app)
 login_manager.login_view = 'login'
 login_manager.login_message = 'Пожалуйста, войдите для доступа к этой странице.'
@@ -97,10 +224,11 @@ class Service(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(200), nullable=False)
     description = db.Column(db.Text, nullable=False)
-    price = db.Column(db.Numeric(10, 2), nullable=False)
-    category = db.Column(db.String(50), nullable=False)
+    price = db.Column(db.Numeric(10, 2), nullable=False, index=True)
+    category = db.Column(db.String(50), nullable=False, index=True)
     image_url = db.Column(db.String(300))
     created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
     order_items = db.relationship('OrderItem', backref='service', lazy=True)
     cart_items = db.relationship('CartItem', backref='service', lazy=True)
@@ -119,7 +247,8 @@ class News(db.Model):
     title = db.Column(db.String(200), nullable=False)
     content = db.Column(db.Text, nullable=False)
     image_url = db.Column(db.String(300))
-    date_posted = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    date_posted = db.Column(db.DateTime, default=datetime.utcnow, nullable=False, index=True)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
     def __repr__(self):
         return f'<News {self.title}>'
@@ -135,102 +264,2055 @@ class Portfolio(db.Model):
     category = db.Column(db.String(50), nullable=False)
     image_url = db.Column(db.String(300), nullable=False)
     event_type = db.Column(db.String(100))
-    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False, index=True)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
     def __repr__(self):
         return f'<Portfolio {self.title}>'
 
-class Order(db.Model):
-    """
-    Заказы.
+class Order(db.Model):
+    """
+    Заказы.
+
+    """
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    total_price = db.Column(db.Numeric(10, 2), nullable=False)
+    status = db.Column(db.String(50), default='Новый', nullable=False, index=True)
+    contact_phone = db.Column(db.String(20), nullable=False)
+    event_date = db.Column(db.Date, nullable=False, index=True)
+    date_created = db.Column(db.DateTime, default=datetime.utcnow, nullable=False, index=True)
+
+    order_items = db.relationship('OrderItem', backref='order', lazy=True, cascade='all, delete-orphan')
+
+    # AUTOINCREMENT: id удалённых и перенесённых в архив заказов не выдаются повторно.
+    __table_args__ = (db.Index('ix_order_user_id_date_created', 'user_id', 'date_created'),
+                      {'sqlite_autoincrement': True})
+
+    def __repr__(self):
+        return f'<Order {self.id}>'
+
+class SiteStat(db.Model):
+    """
+    Материализованные счётчики для статистики админ-панели.
+
+    Обновляются в тех же транзакциях, что и сами записи (bump_stat),
+    и периодически сверяются с таблицами (reconcile_stats). Служебные записи
+    reconciled_at и analytics_refreshed_at хранят Unix-время, поэтому value — BIGINT.
+    """
+
+    name = db.Column(db.String(50), primary_key=True)
+    value = db.Column(db.BigInteger, nullable=False, default=0)
+
+    def __repr__(self):
+        return f'<SiteStat {self.name}={self.value}>'
+
+class SchemaMigration(db.Model):
+    """
+    Применённая миграция схемы (см. MIGRATIONS и run_migrations).
+    """
+
+    __tablename__ = 'schema_migration'
+
+    version = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    name = db.Column(db.String(200), nullable=False)
+    applied_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+    def __repr__(self):
+        return f'<SchemaMigration {self.version}>'
+
+class DailyRevenue(db.Model):
+    """
+    Дневная сводка заказов для аналитики: число заказов и их сумма
+    по дате создания, без отменённых. Заполняется refresh_analytics().
+    """
+
+    __tablename__ = 'daily_revenue'
+
+    day = db.Column(db.Date, primary_key=True)
+    orders = db.Column(db.Integer, nullable=False, default=0)
+    revenue = db.Column(db.Numeric(12, 2), nullable=False, default=0)
+
+    def __repr__(self):
+        return f'<DailyRevenue {self.day}: {self.orders} / {self.revenue}>'
+
+class DailyServiceSales(db.Model):
+    """
+    Дневная сводка продаж по услугам: число позиций (quantity) и сумма price_at_moment.
+    Заполняется refresh_analytics().
+    """
+
+    __tablename__ = 'daily_service_sales'
+
+    day = db.Column(db.Date, primary_key=True)
+    service_id = db.Column(db.Integer, db.ForeignKey('service.id'), primary_key=True)
+    quantity = db.Column(db.Integer, nullable=False, default=0)
+    revenue = db.Column(db.Numeric(12, 2), nullable=False, default=0)
+
+    def __repr__(self):
+        return f'<DailyServiceSales {self.day} Service:{self.service_id}>'
+
+class AnalyticsDirtyDay(db.Model):
+    """
+    День создания заказов, сводки за который нужно пересчитать: у заказа
+    сменился статус или он удалён. Отмечается mark_analytics_dirty()
+    в транзакции изменения и снимается refresh_analytics().
+    """
+
+    __tablename__ = 'analytics_dirty_day'
+
+    day = db.Column(db.Date, primary_key=True)
+    marked_at = db.Column(db.DateTime, nullable=False)
+
+    def __repr__(self):
+        return f'<AnalyticsDirtyDay {self.day}>'
+
+class OrderEvent(db.Model):
+    """
+    Журнал событий заказов (только добавление) для SSE-потока админ-панели.
+
+    Запись добавляется в той же транзакции, что и изменение заказа,
+    поэтому подключения в других воркерах видят событие после коммита.
+    """
+
+    __tablename__ = 'order_event'
+
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(30), nullable=False)
+    order_id = db.Column(db.Integer, nullable=False)
+    payload = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False, index=True)
+
+    def __repr__(self):
+        return f'<OrderEvent {self.id} {self.kind} Order:{self.order_id}>'
+
+class OrderItem(db.Model):
+    """
+    Позиции в заказе.
+
+    """
+
+    id = db.Column(db.Integer, primary_key=True)
+    order_id = db.Column(db.Integer, db.ForeignKey('order.id'), nullable=False, index=True)
+    service_id = db.Column(db.Integer, db.ForeignKey('service.id'), nullable=False, index=True)
+    price_at_moment = db.Column(db.Numeric(10, 2), nullable=False)
+
+    __table_args__ = {'sqlite_autoincrement': True}
+
+    def __repr__(self):
+        return f'<OrderItem Order:{self.order_id} Service:{self.service_id}>'
+
+class ArchivedOrder(db.Model):
+    """
+    Архив выполненных и отменённых заказов (холодные данные).
+
+    Столбцы и id совпадают с Order; записи переносит archive_orders().
+    """
+
+    __tablename__ = 'order_archive'
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    total_price = db.Column(db.Numeric(10, 2), nullable=False)
+    status = db.Column(db.String(50), nullable=False)
+    contact_phone = db.Column(db.String(20), nullable=False)
+    event_date = db.Column(db.Date, nullable=False)
+    date_created = db.Column(db.DateTime, nullable=False)
+    archived_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+    __table_args__ = (db.Index('ix_order_archive_user_id_date_created', 'user_id', 'date_created'),)
+
+    def __repr__(self):
+        return f'<ArchivedOrder {self.id}>'
+
+class ArchivedOrderItem(db.Model):
+    """
+    Позиции архивных заказов. Столбцы и id совпадают с OrderItem.
+    """
+
+    __tablename__ = 'order_item_archive'
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    order_id = db.Column(db.Integer, db.ForeignKey('order_archive.id'), nullable=False, index=True)
+    service_id = db.Column(db.Integer, db.ForeignKey('service.id'), nullable=False)
+    price_at_moment = db.Column(db.Numeric(10, 2), nullable=False)
+
+    def __repr__(self):
+        return f'<ArchivedOrderItem Order:{self.order_id} Service:{self.service_id}>'
+
+ORDER_TABLES = ((Order, OrderItem), (ArchivedOrder, ArchivedOrderItem))
+
+CALENDAR_MAX_DAYS = 366
+CALENDAR_CACHE_MONTHS = 36
+CALENDAR_EXCLUDED_STATUSES = ('Отменен',)
+
+_bookings_lock = threading.Lock()
+_bookings_by_month = OrderedDict()
+
+def month_start(day):
+    """
+    Первое число месяца, в который попадает дата.
+    """
+    return day.replace(day=1)
+
+def next_month_start(day):
+    """
+    Первое число следующего месяца.
+    """
+    return (day.replace(day=28) + timedelta(days=4)).replace(day=1)
+
+def get_bookings(date_from, date_to, fresh=False):
+    """
+    Возвращает {дата мероприятия: число заказов} за период (отменённые не считаются).
+
+    Результат кэшируется по месяцам на CALENDAR_CACHE_TTL секунд; все
+    недостающие месяцы считаются одним GROUP BY по индексу event_date.
+    fresh=True пересчитывает месяцы периода без учёта кэша.
+    """
+    ttl = app.config['CALENDAR_CACHE_TTL']
+    now = time.monotonic()
+
+    months = []
+    month = month_start(date_from)
+    while month <= date_to:
+        months.append(month)
+        month = next_month_start(month)
+
+    cached = {}
+    with _bookings_lock:
+        for month in months:
+            entry = _bookings_by_month.get(month)
+            if entry and not fresh and now - entry[0] <= ttl:
+                cached[month] = entry[1]
+
+    missing = [month for month in months if month not in cached]
+    if missing:
+        rows = db.session.query(Order.event_date, func.count(Order.id))\
+                         .filter(Order.event_date >= missing[0],
+                                 Order.event_date < next_month_start(missing[-1]),
+                                 Order.status.notin_(CALENDAR_EXCLUDED_STATUSES))\
+                         .group_by(Order.event_date)\
+                         .all()
+        loaded = {month: {} for month in missing}
+        for event_date, count in rows:
+            month = month_start(event_date)
+            if month in loaded:
+                loaded[month][event_date] = count
+
+        with _bookings_lock:
+            for month, bookings in loaded.items():
+                _bookings_by_month[month] = (now, bookings)
+                _bookings_by_month.move_to_end(month)
+            while len(_bookings_by_month) > CALENDAR_CACHE_MONTHS:
+                _bookings_by_month.popitem(last=False)
+        cached.update(loaded)
+
+    result = {}
+    for bookings in cached.values():
+        for event_date, count in bookings.items():
+            if date_from <= event_date <= date_to:
+                result[event_date] = count
+    return result
+
+def invalidate_bookings(*event_dates):
+    """
+    Сбрасывает кэш календаря для месяцев указанных дат мероприятий.
+    """
+    with _bookings_lock:
+        for event_date in event_dates:
+            if event_date:
+                _bookings_by_month.pop(month_start(event_date), None)
+
+BOOKING_LOCK_NAMESPACE = 420019
+
+def begin_write_transaction():
+    """
+    В SQLite сразу открывает пишущую транзакцию (как BEGIN IMMEDIATE): пустой
+    UPDATE захватывает блокировку записи, и до коммита другие пишущие запросы ждут.
+
+    В PostgreSQL ничего не делает — там строки блокируются через FOR UPDATE.
+    """
+    if not is_postgresql():
+        db.session.execute(text("UPDATE site_stat SET value = value WHERE name = 'total_orders'"))
+
+def lock_event_date(event_date):
+    """
+    Блокирует дату мероприятия до конца текущей транзакции, чтобы проверка
+    DAILY_EVENT_CAPACITY и вставка заказа выполнялись атомарно.
+
+    В PostgreSQL берётся транзакционная advisory-блокировка по дате.
+    В SQLite открывается пишущая транзакция: другие оформления ждут её коммита,
+    а подсчёт видит все зафиксированные заказы.
+    """
+    if is_postgresql():
+        db.session.execute(text('SELECT pg_advisory_xact_lock(:namespace, :day)'),
+                           {'namespace': BOOKING_LOCK_NAMESPACE, 'day': event_date.toordinal()})
+    else:
+        begin_write_transaction()
+
+ServiceSnapshot = namedtuple(
+    'ServiceSnapshot',
+    ['id', 'title', 'description', 'price', 'category', 'image_url', 'created_at', 'updated_at']
+)
+
+_catalog_lock = threading.Lock()
+_catalog = {
+    'version': 0, 'built_version': -1, 'built_at': 0.0,
+    'services': (), 'by_id': {}, 'last_modified': None
+}
+
+def get_catalog():
+    """
+    Возвращает неизменяемый снимок каталога услуг.
+
+    Снимок перестраивается одним запросом только после invalidate_catalog()
+    или по истечении CATALOG_CACHE_TTL (страховка для нескольких воркеров).
+    """
+    ttl = app.config.get('CATALOG_CACHE_TTL', 0)
+    expired = ttl > 0 and time.monotonic() - _catalog['built_at'] > ttl
+
+    if _catalog['built_version'] == _catalog['version'] and not expired:
+        return _catalog
+
+    with _catalog_lock:
+        version = _catalog['version']
+        expired = ttl > 0 and time.monotonic() - _catalog['built_at'] > ttl
+        if _catalog['built_version'] != version or expired:
+            services = tuple(
+                ServiceSnapshot(
+                    id=service.id,
+                    title=service.title,
+                    description=service.description,
+                    price=service.price,
+                    category=service.category,
+                    image_url=service.image_url,
+                    created_at=service.created_at,
+                    updated_at=service.updated_at or service.created_at
+                )
+                for service in Service.query.order_by(Service.id).all()
+            )
+            _catalog['services'] = services
+            _catalog['by_id'] = {service.id: service for service in services}
+            _catalog['last_modified'] = max((service.updated_at for service in services), default=None)
+            _catalog['built_at'] = time.monotonic()
+            _catalog['built_version'] = version
+            app.logger.debug(f'Каталог услуг перестроен: {len(services)} услуг, версия {version}')
+
+    return _catalog
+
+def invalidate_catalog():
+    """
+    Помечает снимок каталога устаревшим после изменения услуг администратором.
+    """
+    with _catalog_lock:
+        _catalog['version'] += 1
+
+class ResponseCache:
+    """
+    Ограниченный LRU-кэш готовых ответов с TTL и сбросом по тегам.
+
+    Каждая запись помечается тегами разделов (services, news, portfolio),
+    чтобы обработчики админ-панели сбрасывали только затронутые страницы.
+    """
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if time.monotonic() > entry['expires']:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def set(self, key, body, status, headers, tags):
+        with self._lock:
+            self._entries[key] = {
+                'body': body,
+                'status': status,
+                'headers': headers,
+                'tags': frozenset(tags),
+                'expires': time.monotonic() + self.ttl
+            }
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, tag=None):
+        """
+        Удаляет записи с указанным тегом или весь кэш, если тег не задан.
+        """
+        with self._lock:
+            if tag is None:
+                self._entries.clear()
+                return
+            for key in [key for key, entry in self._entries.items() if tag in entry['tags']]:
+                del self._entries[key]
+
+response_cache = ResponseCache(app.config['RESPONSE_CACHE_MAX_ENTRIES'], app.config['RESPONSE_CACHE_TTL'])
+
+def cached_page(*tags):
+    """
+    Декоратор: кэширует ответ публичной страницы для анонимных GET-запросов.
+
+    Ключ — путь со строкой запроса и формат ответа (HTML/JSON). Кэш обходится
+    для авторизованных пользователей и при ожидающих flash-сообщениях;
+    ответы, изменившие сессию, не сохраняются. Включается RESPONSE_CACHE_ENABLED.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if not app.config['RESPONSE_CACHE_ENABLED'] or request.method != 'GET' \
+                    or current_user.is_authenticated or '_flashes' in session:
+                return view(*args, **kwargs)
+
+            key = (request.full_path, wants_json())
+            entry = response_cache.get(key)
+            if entry is not None:
+                response = app.response_class(entry['body'], status=entry['status'], headers=entry['headers'])
+                response.headers['X-Cache'] = 'HIT'
+                return response
+
+            response = make_response(view(*args, **kwargs))
+            if response.status_code == 200 and not session.modified and not response.direct_passthrough:
+                response_cache.set(key, response.get_data(), response.status_code,
+                                   list(response.headers.items()), tags)
+            response.headers['X-Cache'] = 'MISS'
+            return response
+        return wrapper
+    return decorator
+
+def conditional_page(get_validators):
+    """
+    Декоратор: отвечает 304 Not Modified без рендера, если страница не менялась.
+
+    get_validators(**kwargs) возвращает (last_modified, части ETag) или None,
+    если валидаторы посчитать нельзя (например, записи нет). ETag также
+    учитывает адрес, формат ответа и пользователя, так как шапка страницы
+    зависит от авторизации.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if request.method != 'GET' or '_flashes' in session:
+                return view(*args, **kwargs)
+
+            validators = get_validators(**kwargs)
+            if validators is None:
+                return view(*args, **kwargs)
+
+            last_modified, parts = validators
+            last_modified = (last_modified or datetime(1970, 1, 1)).replace(microsecond=0, tzinfo=timezone.utc)
+            key = '|'.join(str(part) for part in (
+                *parts, last_modified.isoformat(), request.full_path, wants_json(), current_user.get_id()
+            ))
+            etag = hashlib.sha1(key.encode()).hexdigest()[:32]
+
+            if request.if_none_match:
+                not_modified = request.if_none_match.contains_weak(etag)
+            else:
+                not_modified = request.if_modified_since is not None \
+                    and last_modified <= request.if_modified_since
+
+            if not_modified:
+                response = app.response_class(status=304)
+            else:
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+
+            response.set_etag(etag, weak=True)
+            response.last_modified = last_modified
+            return response
+        return wrapper
+    return decorator
+
+def catalog_validators(**kwargs):
+    """
+    Валидаторы страниц каталога: время последнего изменения и число услуг из снимка.
+    """
+    catalog = get_catalog()
+    return catalog['last_modified'], (len(catalog['services']),)
+
+def service_validators(id):
+    """
+    Валидаторы страницы услуги из снимка каталога.
+    """
+    service = get_catalog()['by_id'].get(id)
+    if service is None:
+        return None
+    return service.updated_at, (service.id,)
+
+def news_list_validators():
+    """
+    Валидаторы списка новостей: одно агрегатное обращение к таблице.
+    """
+    last_modified, count = db.session.query(
+        func.max(func.coalesce(News.updated_at, News.date_posted)), func.count(News.id)
+    ).one()
+    return last_modified, (count,)
+
+def news_validators(id):
+    """
+    Валидаторы страницы новости по её updated_at.
+    """
+    row = db.session.query(News.updated_at, News.date_posted).filter(News.id == id).first()
+    if row is None:
+        return None
+    return row.updated_at or row.date_posted, (id,)
+
+def portfolio_validators():
+    """
+    Валидаторы портфолио: одно агрегатное обращение к таблице.
+    """
+    last_modified, count = db.session.query(
+        func.max(func.coalesce(Portfolio.updated_at, Portfolio.created_at)), func.count(Portfolio.id)
+    ).one()
+    return last_modified, (count,)
+
+SERVICE_CATEGORIES = {
+    'Детский': ['Детский', 'детский'],
+    'Взрослый': ['Взрослый', 'взрослый'],
+    'Корпоративный': ['Корпоративный', 'корпоратив'],
+}
+
+SERVICE_SORTS = {
+    'default': (Service.id.asc(),),
+    'price_asc': (Service.price.asc(), Service.id.asc()),
+    'price_desc': (Service.price.desc(), Service.id.desc()),
+    'newest': (Service.created_at.desc(), Service.id.desc()),
+}
+
+SERVICES_PER_PAGE = 12
+
+def get_service_filters(args):
+    """
+    Разбирает параметры фильтрации каталога из строки запроса.
+
+    Некорректные значения игнорируются, чтобы ссылка с мусором в параметрах
+    всё равно открывала каталог.
+    """
+    filters = {
+        'category': args.get('category', '').strip(),
+        'min_price': None,
+        'max_price': None,
+        'sort': args.get('sort', 'default'),
+        'page': args.get('page', 1, type=int) or 1,
+        'per_page': min(max(args.get('per_page', SERVICES_PER_PAGE, type=int) or SERVICES_PER_PAGE, 1), 48),
+    }
+
+    if filters['category'] not in SERVICE_CATEGORIES:
+        filters['category'] = ''
+    if filters['sort'] not in SERVICE_SORTS:
+        filters['sort'] = 'default'
+    if filters['page'] < 1:
+        filters['page'] = 1
+
+    for key in ('min_price', 'max_price'):
+        try:
+            value = float(args.get(key, '').replace(',', '.'))
+            if value >= 0:
+                filters[key] = value
+        except ValueError:
+            pass
+
+    return filters
+
+NEWS_PER_PAGE = 9
+PORTFOLIO_PER_PAGE = 24
+ADMIN_PER_PAGE = 50
+ORDERS_PER_PAGE = 20
+
+def wants_json():
+    """
+    Определяет, ожидает ли клиент ответ в формате JSON.
+    """
+    return request.headers.get('X-Requested-With') == 'XMLHttpRequest' \
+        or request.is_json \
+        or request.args.get('format') == 'json' \
+        or request.accept_mimetypes.best == 'application/json'
+
+def encode_cursor(value, row_id):
+    """
+    Кодирует позицию последней строки страницы в курсор для ссылки «дальше».
+    """
+    if isinstance(value, datetime):
+        value = value.isoformat()
+    raw = f'{value}|{row_id}'.encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+def decode_cursor(cursor, column):
+    """
+    Разбирает курсор, созданный encode_cursor().
+
+    Возвращает пару (значение сортировки, id) или None для некорректного курсора.
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        value, row_id = raw.rsplit('|', 1)
+        if isinstance(column.type, db.DateTime):
+            value = datetime.fromisoformat(value)
+        else:
+            value = int(value)
+        return value, int(row_id)
+    except (ValueError, UnicodeDecodeError):
+        return None
+
+def keyset_page(query, column, id_column, cursor, per_page):
+    """
+    Возвращает страницу строк по убыванию (column, id) и курсор следующей страницы.
+
+    Вместо OFFSET используется условие «строго после последней строки»,
+    поэтому каждая страница — это диапазонный просмотр индекса по column,
+    и время ответа не растёт с номером страницы.
+    """
+    position = decode_cursor(cursor, column) if cursor else None
+
+    if position:
+        value, last_id = position
+        if column is id_column:
+            query = query.filter(id_column < last_id)
+        else:
+            query = query.filter(or_(column < value, and_(column == value, id_column < last_id)))
+
+    if column is id_column:
+        query = query.order_by(id_column.desc())
+    else:
+        query = query.order_by(column.desc(), id_column.desc())
+
+    rows = query.limit(per_page + 1).all()
+
+    next_cursor = None
+    if len(rows) > per_page:
+        rows = rows[:per_page]
+        last = rows[-1]
+        if isinstance(last, Row) and column.key not in last._fields:
+            last = last[0]
+        next_cursor = encode_cursor(getattr(last, column.key), getattr(last, id_column.key))
+
+    return rows, next_cursor
+
+def service_to_dict(service):
+    """
+    Сериализует услугу для JSON-ответов и скриптов админ-панели.
+    """
+    return {
+        'id': service.id,
+        'title': service.title,
+        'description': service.description,
+        'price': float(service.price) if service.price else 0.0,
+        'category': service.category,
+        'image_url': service.image_url,
+        'created_at': service.created_at.strftime('%d.%m.%Y') if service.created_at else None
+    }
+
+def news_to_dict(news_item):
+    """
+    Сериализует новость для JSON-ответов и скриптов админ-панели.
+    """
+    return {
+        'id': news_item.id,
+        'title': news_item.title,
+        'content': news_item.content,
+        'image_url': news_item.image_url,
+        'date_posted': news_item.date_posted.strftime('%d.%m.%Y %H:%M')
+    }
+
+def portfolio_to_dict(item):
+    """
+    Сериализует работу портфолио для JSON-ответов и скриптов админ-панели.
+    """
+    return {
+        'id': item.id,
+        'title': item.title,
+        'category': item.category,
+        'image_url': item.image_url,
+        'event_type': item.event_type,
+        'created_at': item.created_at.strftime('%d.%m.%Y') if item.created_at else None
+    }
+
+def order_to_dict(order, user):
+    """
+    Сериализует заказ с данными клиента для JSON-ответов и скриптов админ-панели.
+    """
+    return {
+        'id': order.id,
+        'status': order.status,
+        'total_amount': float(order.total_price),
+        'date_created': order.date_created.strftime('%d.%m.%Y %H:%M'),
+        'user_name': user.username if user else 'Неизвестный',
+        'user_email': user.email if user else 'Неизвестно'
+    }
+
+def load_order_history(user_id, cursor=None, per_page=ORDERS_PER_PAGE, include_archive=False):
+    """
+    Загружает страницу заказов пользователя вместе с позициями.
+
+    Два запроса на страницу независимо от числа заказов: заказы по индексу
+    (user_id, date_created) и все их позиции с услугами одним IN-запросом.
+    С include_archive=True страница собирается из живых и архивных заказов
+    (ещё по одному запросу к архивным таблицам).
+    Возвращает список {'order', 'order_items', 'archived'} и курсор следующей страницы.
+    """
+    orders, next_cursor = keyset_page(
+        Order.query.filter(Order.user_id == user_id), Order.date_created, Order.id, cursor, per_page
+    )
+
+    if include_archive:
+        archived, archived_cursor = keyset_page(
+            ArchivedOrder.query.filter(ArchivedOrder.user_id == user_id),
+            ArchivedOrder.date_created, ArchivedOrder.id, cursor, per_page
+        )
+        merged = sorted(orders + archived, key=lambda order: (order.date_created, order.id), reverse=True)
+        has_more = len(merged) > per_page or next_cursor or archived_cursor
+        orders = merged[:per_page]
+        next_cursor = encode_cursor(orders[-1].date_created, orders[-1].id) if has_more and orders else None
+
+    # Ключ включает модель: живой и архивный заказ различаются таблицей.
+    items_by_order = {(type(order), order.id): [] for order in orders}
+    for order_model, item_model in ORDER_TABLES:
+        order_ids = [order.id for order in orders if isinstance(order, order_model)]
+        if not order_ids:
+            continue
+        rows = db.session.query(item_model, Service)\
+                         .join(Service, item_model.service_id == Service.id)\
+                         .filter(item_model.order_id.in_(order_ids))\
+                         .order_by(item_model.id)\
+                         .all()
+        for order_item, service in rows:
+            items_by_order[(order_model, order_item.order_id)].append((order_item, service))
+
+    return [
+        {'order': order, 'order_items': items_by_order[(type(order), order.id)],
+         'archived': isinstance(order, ArchivedOrder)}
+        for order in orders
+    ], next_cursor
+
+ARCHIVE_STATUSES = ('Выполнен', 'Завершен', 'Отменен')
+ARCHIVE_BATCH_SIZE = 500
+
+ORDER_ARCHIVE_COLUMNS = ('id', 'user_id', 'total_price', 'status', 'contact_phone', 'event_date', 'date_created')
+ORDER_ITEM_ARCHIVE_COLUMNS = ('id', 'order_id', 'service_id', 'price_at_moment')
+
+def archive_orders(older_than_days=None, batch_size=ARCHIVE_BATCH_SIZE):
+    """
+    Переносит выполненные и отменённые заказы старше older_than_days дней
+    (по дате создания) в архивные таблицы вместе с позициями.
+
+    Каждая пачка из batch_size заказов переносится в своей транзакции
+    через INSERT ... SELECT и DELETE, чтобы не держать блокировку долго.
+    Условие отбора повторяется в каждом запросе пачки, а строки заказов
+    блокируются (FOR UPDATE в PostgreSQL, пишущая транзакция в SQLite):
+    заказ, статус которого успели сменить, остаётся в живой таблице.
+    Счётчик total_orders учитывает архив, поэтому статистика не меняется.
+    Возвращает число перенесённых заказов.
+    """
+    if older_than_days is None:
+        older_than_days = app.config['ORDER_ARCHIVE_AFTER_DAYS']
+    cutoff = datetime.utcnow() - timedelta(days=older_than_days)
+    archivable = (Order.status.in_(ARCHIVE_STATUSES), Order.date_created < cutoff)
+
+    moved = 0
+    while True:
+        order_ids = [order_id for order_id, in db.session.query(Order.id)
+                     .filter(*archivable)
+                     .order_by(Order.id)
+                     .limit(batch_size)
+                     .with_for_update()]
+        if not order_ids:
+            break
+
+        db.session.execute(insert(ArchivedOrder).from_select(
+            ORDER_ARCHIVE_COLUMNS,
+            select(*(getattr(Order, name) for name in ORDER_ARCHIVE_COLUMNS))
+            .where(Order.id.in_(order_ids), *archivable)
+        ))
+        archived_ids = select(ArchivedOrder.id).where(ArchivedOrder.id.in_(order_ids))
+        db.session.execute(insert(ArchivedOrderItem).from_select(
+            ORDER_ITEM_ARCHIVE_COLUMNS,
+            select(*(getattr(OrderItem, name) for name in ORDER_ITEM_ARCHIVE_COLUMNS))
+            .where(OrderItem.order_id.in_(archived_ids))
+        ))
+        db.session.execute(delete(OrderItem).where(OrderItem.order_id.in_(archived_ids)))
+        result = db.session.execute(delete(Order).where(Order.id.in_(order_ids), *archivable))
+        db.session.commit()
+        moved += result.rowcount
+
+    if moved:
+        app.logger.info(f'В архив перенесено заказов: {moved}')
+    return moved
+
+STAT_QUERIES = {
+    'total_services': lambda: Service.query.count(),
+    'total_news': lambda: News.query.count(),
+    'total_portfolio': lambda: Portfolio.query.count(),
+    'total_orders': lambda: Order.query.count() + ArchivedOrder.query.count(),
+    'new_orders': lambda: Order.query.filter_by(status='Новый').count(),
+    'total_users': lambda: User.query.count(),
+}
+
+def bump_stat(name, delta=1):
+    """
+    Изменяет счётчик статистики в текущей транзакции.
+
+    Инкремент выполняется одним UPDATE на стороне базы, поэтому
+    параллельные запросы не теряют изменения.
+    """
+    SiteStat.query.filter_by(name=name).update(
+        {SiteStat.value: SiteStat.value + delta}, synchronize_session=False
+    )
+
+def reconcile_stats():
+    """
+    Пересчитывает все счётчики по таблицам и исправляет накопившиеся расхождения.
+
+    Возвращает словарь исправлений {имя: (было, стало)}.
+    """
+    current = {stat.name: stat.value for stat in SiteStat.query.all()}
+    fixed = {}
+
+    for name, query in STAT_QUERIES.items():
+        value = query()
+        if name in current and current[name] != value:
+            fixed[name] = (current[name], value)
+        db.session.merge(SiteStat(name=name, value=value))
+
+    db.session.merge(SiteStat(name='reconciled_at', value=int(time.time())))
+    db.session.commit()
+
+    if fixed:
+        app.logger.warning(f'Статистика сверена, исправлены расхождения: {fixed}')
+    return fixed
+
+def get_admin_stats():
+    """
+    Возвращает статистику админ-панели одним чтением таблицы site_stat.
+
+    Если счётчиков ещё нет или сверка давно не выполнялась,
+    предварительно запускает reconcile_stats().
+    """
+    stats = {stat.name: stat.value for stat in SiteStat.query.all()}
+    interval = app.config['STATS_RECONCILE_INTERVAL']
+
+    if any(name not in stats for name in STAT_QUERIES) \
+            or (interval > 0 and time.time() - stats.get('reconciled_at', 0) > interval):
+        reconcile_stats()
+        stats = {stat.name: stat.value for stat in SiteStat.query.all()}
+
+    return {name: stats[name] for name in STAT_QUERIES}
+
+ANALYTICS_BATCH_SIZE = 1000
+ANALYTICS_EXCLUDED_STATUSES = ('Отменен',)
+ANALYTICS_RESCAN_WINDOW = timedelta(hours=1)
+
+def mark_analytics_dirty(*created):
+    """
+    Отмечает дни создания заказов (date_created) для пересчёта сводок.
+
+    Вызывается в транзакции, которая меняет статус или удаляет заказ,
+    поэтому отметка фиксируется вместе с самим изменением.
+    """
+    days = {value.date() for value in created if value}
+    if not days:
+        return
+
+    now = datetime.utcnow()
+    stmt = upsert(AnalyticsDirtyDay).values([{'day': day, 'marked_at': now} for day in days])
+    db.session.execute(stmt.on_conflict_do_update(
+        index_elements=['day'], set_={'marked_at': stmt.excluded.marked_at}
+    ))
+
+def day_ranges(days):
+    """
+    Сворачивает набор дат в непрерывные полуоткрытые диапазоны [начало, конец).
+    """
+    ranges = []
+    for day in sorted(days):
+        if ranges and ranges[-1][1] == day:
+            ranges[-1][1] = day + timedelta(days=1)
+        else:
+            ranges.append([day, day + timedelta(days=1)])
+    return ranges
+
+def rebuild_rollups(date_from, date_to):
+    """
+    Пересчитывает дневные сводки за дни [date_from, date_to) по живым
+    и архивным заказам, кроме отменённых.
+
+    Сводки за эти дни перезаписываются целиком, поэтому повторный пересчёт
+    того же дня ничего не удваивает. Возвращает число учтённых заказов.
+    """
+    start = datetime.combine(date_from, datetime.min.time())
+    end = datetime.combine(date_to, datetime.min.time())
+
+    db.session.execute(delete(DailyServiceSales).where(DailyServiceSales.day >= date_from,
+                                                       DailyServiceSales.day < date_to))
+    db.session.execute(delete(DailyRevenue).where(DailyRevenue.day >= date_from, DailyRevenue.day < date_to))
+
+    revenue = defaultdict(lambda: [0, Decimal(0)])
+    sales = defaultdict(lambda: [0, Decimal(0)])
+    processed = 0
+
+    # Живые и архивные заказы читаются одним UNION ALL, чтобы заказ,
+    # переносимый в архив в это же время, не учёлся дважды или ни разу.
+    orders = db.session.execute(union_all(*(
+        select(order_model.date_created, order_model.total_price)
+        .where(order_model.date_created >= start, order_model.date_created < end,
+               order_model.status.notin_(ANALYTICS_EXCLUDED_STATUSES))
+        for order_model, _ in ORDER_TABLES
+    )), execution_options={'yield_per': ANALYTICS_BATCH_SIZE})
+    for date_created, total_price in orders:
+        day = revenue[date_created.date()]
+        day[0] += 1
+        day[1] += Decimal(total_price)
+        processed += 1
+
+    items = db.session.execute(union_all(*(
+        select(order_model.date_created, item_model.service_id, item_model.price_at_moment)
+        .join(order_model, item_model.order_id == order_model.id)
+        .where(order_model.date_created >= start, order_model.date_created < end,
+               order_model.status.notin_(ANALYTICS_EXCLUDED_STATUSES))
+        for order_model, item_model in ORDER_TABLES
+    )), execution_options={'yield_per': ANALYTICS_BATCH_SIZE})
+    for date_created, service_id, price in items:
+        day = sales[(date_created.date(), service_id)]
+        day[0] += 1
+        day[1] += Decimal(price)
+
+    # Параллельный пересчёт тех же дней мог уже вставить строки:
+    # они перезаписываются, а не складываются.
+    if revenue:
+        stmt = upsert(DailyRevenue).values([
+            {'day': day, 'orders': count, 'revenue': amount}
+            for day, (count, amount) in revenue.items()
+        ])
+        db.session.execute(stmt.on_conflict_do_update(
+            index_elements=['day'],
+            set_={'orders': stmt.excluded.orders, 'revenue': stmt.excluded.revenue}
+        ))
+
+    if sales:
+        stmt = upsert(DailyServiceSales).values([
+            {'day': day, 'service_id': service_id, 'quantity': count, 'revenue': amount}
+            for (day, service_id), (count, amount) in sales.items()
+        ])
+        db.session.execute(stmt.on_conflict_do_update(
+            index_elements=['day', 'service_id'],
+            set_={'quantity': stmt.excluded.quantity, 'revenue': stmt.excluded.revenue}
+        ))
+
+    return processed
+
+def refresh_analytics(full=False):
+    """
+    Обновляет дневные сводки аналитики.
+
+    Пересчитываются дни, начиная с момента прошлого обновления минус
+    ANALYTICS_RESCAN_WINDOW, и дни, отмеченные mark_analytics_dirty()
+    (смена статуса, удаление заказа). Окно по дате создания, а не по id,
+    подхватывает и заказы, зафиксированные позже заказов с большим id.
+    full=True (flask refresh-analytics --full) пересобирает всё.
+    Возвращает число учтённых заказов.
+    """
+    started_ts = int(time.time())
+    started = datetime.utcfromtimestamp(started_ts)
+    refreshed_at = db.session.get(SiteStat, 'analytics_refreshed_at')
+
+    # Отметки снимаются первой записью транзакции: отметка, поставленная
+    # во время пересчёта, получит новый marked_at и останется до следующего.
+    dirty = db.session.query(AnalyticsDirtyDay.day, AnalyticsDirtyDay.marked_at).all()
+    if dirty:
+        db.session.execute(delete(AnalyticsDirtyDay).where(or_(*(
+            and_(AnalyticsDirtyDay.day == day, AnalyticsDirtyDay.marked_at == marked_at)
+            for day, marked_at in dirty
+        ))))
+
+    date_to = started.date() + timedelta(days=1)
+    if full or refreshed_at is None:
+        first_created = min((created for created in (
+            db.session.query(func.min(order_model.date_created)).scalar() for order_model, _ in ORDER_TABLES
+        ) if created), default=started)
+        db.session.execute(delete(DailyServiceSales))
+        db.session.execute(delete(DailyRevenue))
+        ranges = [[first_created.date(), date_to]]
+    else:
+        since = (datetime.utcfromtimestamp(refreshed_at.value) - ANALYTICS_RESCAN_WINDOW).date()
+        ranges = day_ranges(day for day, _ in dirty if day < since) + [[since, date_to]]
+
+    processed = sum(rebuild_rollups(date_from, range_end) for date_from, range_end in ranges)
+
+    db.session.merge(SiteStat(name='analytics_refreshed_at', value=started_ts))
+    db.session.commit()
+    app.logger.info(f'Аналитика обновлена: учтено заказов {processed}, пересчитано диапазонов дней {len(ranges)}')
+    return processed
+
+def ensure_analytics_fresh():
+    """
+    Запускает refresh_analytics(), если сводки обновлялись дольше
+    ANALYTICS_REFRESH_INTERVAL секунд назад.
+    """
+    refreshed_at = db.session.get(SiteStat, 'analytics_refreshed_at')
+    if refreshed_at is None or time.time() - refreshed_at.value > app.config['ANALYTICS_REFRESH_INTERVAL']:
+        refresh_analytics()
+
+def get_analytics_period(args):
+    """
+    Разбирает период отчёта date_from/date_to (ГГГГ-ММ-ДД).
+
+    По умолчанию — последние 12 месяцев, включая текущий.
+    Некорректные значения заменяются значениями по умолчанию.
+    """
+    today = datetime.utcnow().date()
+    first_month = today.year * 12 + today.month - 1 - 11
+    period = {'date_from': today.replace(year=first_month // 12, month=first_month % 12 + 1, day=1),
+              'date_to': today}
+
+    for key in period:
+        try:
+            period[key] = datetime.strptime(args.get(key, ''), '%Y-%m-%d').date()
+        except ValueError:
+            pass
+
+    if period['date_from'] > period['date_to']:
+        period['date_from'], period['date_to'] = period['date_to'], period['date_from']
+    return period
+
+def get_analytics_report(date_from, date_to):
+    """
+    Строит отчёт по выручке и спросу за период только по дневным сводкам.
+
+    Возвращает итоги, помесячную разбивку, разбивку по категориям
+    и услуги по убыванию выручки.
+    """
+    months = OrderedDict()
+    days = DailyRevenue.query.filter(DailyRevenue.day.between(date_from, date_to))\
+                             .order_by(DailyRevenue.day).all()
+    for day in days:
+        month = months.setdefault(day.day.strftime('%Y-%m'), {'orders': 0, 'revenue': Decimal(0)})
+        month['orders'] += day.orders
+        month['revenue'] += Decimal(day.revenue)
+
+    service_rows = db.session.query(
+        Service.id, Service.title, Service.category,
+        func.sum(DailyServiceSales.quantity), func.sum(DailyServiceSales.revenue)
+    ).join(Service, DailyServiceSales.service_id == Service.id)\
+     .filter(DailyServiceSales.day.between(date_from, date_to))\
+     .group_by(Service.id, Service.title, Service.category)\
+     .order_by(func.sum(DailyServiceSales.revenue).desc())\
+     .all()
+
+    category_names = {variant: name for name, variants in SERVICE_CATEGORIES.items() for variant in variants}
+    categories = OrderedDict((name, {'quantity': 0, 'revenue': Decimal(0)}) for name in SERVICE_CATEGORIES)
+    services = []
+    for service_id, title, category, quantity, amount in service_rows:
+        category = category_names.get(category, category)
+        bucket = categories.setdefault(category, {'quantity': 0, 'revenue': Decimal(0)})
+        bucket['quantity'] += quantity
+        bucket['revenue'] += Decimal(amount)
+        services.append({'id': service_id, 'title': title, 'category': category,
+                         'quantity': quantity, 'revenue': float(amount)})
+
+    total_orders = sum(month['orders'] for month in months.values())
+    total_revenue = sum((month['revenue'] for month in months.values()), Decimal(0))
+
+    return {
+        'date_from': date_from.isoformat(),
+        'date_to': date_to.isoformat(),
+        'totals': {
+            'orders': total_orders,
+            'revenue': float(total_revenue),
+            'average_order': float(total_revenue / total_orders) if total_orders else 0.0
+        },
+        'months': [
+            {'month': key, 'orders': month['orders'], 'revenue': float(month['revenue'])}
+            for key, month in months.items()
+        ],
+        'categories': [
+            {'category': name, 'quantity': bucket['quantity'], 'revenue': float(bucket['revenue'])}
+            for name, bucket in categories.items()
+        ],
+        'services': services
+    }
+
+ADMIN_SECTIONS = ('orders', 'news', 'services', 'portfolio')
+
+ORDER_STATUSES = ('Новый', 'В обработке', 'Подтвержден', 'Выполнен', 'Отменен', 'Завершен')
+
+BULK_STATUS_MAX_ORDERS = 500
+
+ADMIN_LIST_COLUMNS = {
+    'services': (Service.id, Service.title, Service.category, Service.price),
+    'news': (News.id, News.title, News.date_posted),
+    'portfolio': (Portfolio.id, Portfolio.title, Portfolio.category, Portfolio.event_type,
+                  Portfolio.image_url, Portfolio.created_at),
+    'orders': (Order.id, Order.contact_phone, Order.event_date, Order.total_price, Order.status,
+               Order.date_created, User.username),
+}
+
+ADMIN_LIST_ORDER = {
+    'services': (Service.id, Service.id),
+    'news': (News.date_posted, News.id),
+    'portfolio': (Portfolio.created_at, Portfolio.id),
+    'orders': (Order.date_created, Order.id),
+}
+
+def admin_row_to_dict(section, row):
+    """
+    Сериализует строку таблицы раздела админ-панели.
+
+    Содержит только поля, которые выводятся в таблице: длинные описания
+    и тексты новостей загружаются отдельно при открытии формы редактирования.
+    """
+    if section == 'services':
+        return {
+            'id': row.id,
+            'title': row.title,
+            'category': row.category,
+            'price': float(row.price) if row.price else 0.0
+        }
+    if section == 'news':
+        return {
+            'id': row.id,
+            'title': row.title,
+            'date_posted': row.date_posted.strftime('%d.%m.%Y')
+        }
+    if section == 'portfolio':
+        return {
+            'id': row.id,
+            'title': row.title,
+            'category': row.category,
+            'event_type': row.event_type,
+            'image_url': row.image_url
+        }
+    return {
+        'id': row.id,
+        'user_name': row.username,
+        'contact_phone': row.contact_phone,
+        'event_date': row.event_date.strftime('%d.%m.%Y') if row.event_date else None,
+        'total_price': float(row.total_price),
+        'status': row.status
+    }
+
+def admin_list_query(section):
+    """
+    Запрос строк таблицы раздела админ-панели только с нужными столбцами.
+    """
+    query = db.session.query(*ADMIN_LIST_COLUMNS[section])
+    if section == 'orders':
+        query = query.join(User, Order.user_id == User.id)
+    return query
+
+def get_admin_section_page(section, cursor):
+    """
+    Загружает одну страницу раздела админ-панели по курсору.
+
+    Выбираются только столбцы из ADMIN_LIST_COLUMNS, поэтому объём
+    страницы не зависит от длины описаний и текстов.
+    Возвращает сериализованные строки и курсор следующей страницы.
+    """
+    if section not in ADMIN_SECTIONS:
+        abort(404)
+
+    column, id_column = ADMIN_LIST_ORDER[section]
+    rows, next_cursor = keyset_page(admin_list_query(section), column, id_column, cursor, ADMIN_PER_PAGE)
+    return [admin_row_to_dict(section, row) for row in rows], next_cursor
+
+def get_admin_row(section, id):
+    """
+    Возвращает одну строку таблицы раздела в том же виде, что и /admin/api/<раздел>.
+
+    Используется обработчиками изменений: страница заменяет строку
+    на месте вместо перезагрузки всей админ-панели.
+    """
+    id_column = ADMIN_LIST_ORDER[section][1]
+    row = admin_list_query(section).filter(id_column == id).first()
+    return admin_row_to_dict(section, row) if row else None
+
+ORDER_EVENTS_BATCH_SIZE = 100
+ORDER_EVENTS_RETENTION_DAYS = 7
+
+class OrderEventBroker:
+    """
+    Внутрипроцессная шина событий заказов.
+
+    Не хранит сами события: после коммита будит SSE-подключения этого
+    процесса, и они сразу дочитывают журнал order_event. Подключения
+    в других воркерах увидят событие при очередном опросе журнала.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self.version = 0
+
+    def notify(self):
+        with self._condition:
+            self.version += 1
+            self._condition.notify_all()
+
+    def wait(self, version, timeout):
+        """
+        Ждёт публикации после version не дольше timeout секунд.
+        Возвращает True, если публикация была.
+        """
+        with self._condition:
+            return self._condition.wait_for(lambda: self.version != version, timeout)
+
+order_event_broker = OrderEventBroker()
+
+ORDER_EVENTS_LOCK_KEY = 420020
+
+def record_order_event(kind, order_id, payload):
+    """
+    Добавляет событие заказа в журнал в текущей транзакции.
+
+    Поток читает журнал по возрастанию id, поэтому id должны выдаваться
+    в порядке коммитов. В SQLite это так (один писатель), а в PostgreSQL
+    транзакционная advisory-блокировка до коммита не даёт следующему
+    событию получить id, пока не зафиксировано предыдущее.
+    После коммита нужно вызвать order_event_broker.notify().
+    """
+    if is_postgresql():
+        db.session.execute(text('SELECT pg_advisory_xact_lock(:key)'), {'key': ORDER_EVENTS_LOCK_KEY})
+    db.session.add(OrderEvent(
+        kind=kind,
+        order_id=order_id,
+        payload=json.dumps(payload, ensure_ascii=False)
+    ))
+
+def stream_order_events(last_id):
+    """
+    Генератор SSE-потока событий заказов после события last_id.
+
+    Журнал дочитывается сразу после публикации в этом процессе и не реже
+    чем раз в ORDER_EVENTS_POLL_INTERVAL секунд. Через
+    ORDER_EVENTS_STREAM_DURATION поток закрывается, и браузер
+    переподключается с Last-Event-ID, не теряя событий.
+    """
+    poll_interval = app.config['ORDER_EVENTS_POLL_INTERVAL']
+    deadline = time.monotonic() + app.config['ORDER_EVENTS_STREAM_DURATION']
+
+    yield f'retry: {poll_interval * 1000}\n\n'
+
+    while time.monotonic() < deadline:
+        version = order_event_broker.version
+        events = db.session.query(OrderEvent.id, OrderEvent.kind, OrderEvent.payload)\
+                           .filter(OrderEvent.id > last_id)\
+                           .order_by(OrderEvent.id)\
+                           .limit(ORDER_EVENTS_BATCH_SIZE)\
+                           .all()
+        # Закрываем читающую транзакцию, чтобы следующий опрос видел новые коммиты
+        db.session.rollback()
+
+        for event_id, kind, payload in events:
+            last_id = event_id
+            yield f'id: {event_id}\nevent: {kind}\ndata: {payload}\n\n'
+
+        if len(events) == ORDER_EVENTS_BATCH_SIZE:
+            continue
+
+        if not order_event_broker.wait(version, min(poll_interval, max(deadline - time.monotonic(), 0))):
+            yield ': keepalive\n\n'
+
+def prune_order_events(days=ORDER_EVENTS_RETENTION_DAYS):
+    """
+    Удаляет из журнала события старше days дней. Возвращает число удалённых.
+    """
+    removed = OrderEvent.query.filter(OrderEvent.created_at < datetime.utcnow() - timedelta(days=days))\
+                              .delete(synchronize_session=False)
+    db.session.commit()
+    return removed
+
+EXPORT_BATCH_SIZE = 500
+
+EXPORT_FORMATS = ('csv', 'ndjson')
+
+EXPORT_FIELDS = (
+    'order_id', 'date_created', 'status', 'event_date', 'contact_phone', 'order_total',
+    'username', 'email', 'item_id', 'service_id', 'service_title', 'service_category',
+    'price_at_moment',
+)
+
+def parse_export_filters(args):
+    """
+    Разбирает фильтры выгрузки заказов: date_from, date_to (ГГГГ-ММ-ДД,
+    по дате создания заказа, включительно), один или несколько status
+    и include_archive=1 для выгрузки вместе с архивом.
+
+    В отличие от фильтров каталога некорректные значения не игнорируются:
+    выгрузка для бухгалтерии не должна молча отдавать другой период.
+    Бросает ValueError с описанием ошибки.
+    """
+    filters = {'date_from': None, 'date_to': None, 'statuses': [],
+               'include_archive': args.get('include_archive') == '1'}
+
+    for key in ('date_from', 'date_to'):
+        value = args.get(key, '').strip()
+        if value:
+            try:
+                filters[key] = datetime.strptime(value, '%Y-%m-%d')
+            except ValueError:
+                raise ValueError(f'Неверная дата {key}: ожидается ГГГГ-ММ-ДД')
+
+    for status in args.getlist('status'):
+        status = status.strip()
+        if not status:
+            continue
+        if status not in ORDER_STATUSES:
+            raise ValueError(f'Неверный статус заказа: {status}')
+        filters['statuses'].append(status)
+
+    return filters
+
+def export_orders_select(order_model, item_model, filters):
+    """
+    Выгрузка из одной пары таблиц заказов (живой или архивной).
+    """
+    columns = (
+        order_model.id, order_model.date_created, order_model.status, order_model.event_date,
+        order_model.contact_phone, order_model.total_price, User.username, User.email,
+        item_model.id, Service.id, Service.title, Service.category, item_model.price_at_moment,
+    )
+    stmt = select(*(column.label(name) for name, column in zip(EXPORT_FIELDS, columns)))\
+        .join(User, order_model.user_id == User.id)\
+        .outerjoin(item_model, item_model.order_id == order_model.id)\
+        .outerjoin(Service, item_model.service_id == Service.id)
+
+    if filters['date_from']:
+        stmt = stmt.where(order_model.date_created >= filters['date_from'])
+    if filters['date_to']:
+        stmt = stmt.where(order_model.date_created < filters['date_to'] + timedelta(days=1))
+    if filters['statuses']:
+        stmt = stmt.where(order_model.status.in_(filters['statuses']))
+
+    return stmt
+
+def export_orders_statement(filters):
+    """
+    Запрос выгрузки: по строке на позицию заказа с услугой и клиентом.
+
+    Заказы без позиций тоже попадают в выгрузку (с пустыми полями позиции).
+    С include_archive к живым заказам добавляется архив через UNION ALL.
+    """
+    stmt = export_orders_select(Order, OrderItem, filters)
+    if filters['include_archive']:
+        stmt = union_all(stmt, export_orders_select(ArchivedOrder, ArchivedOrderItem, filters))
+    return stmt.order_by(literal_column('order_id'), literal_column('item_id'))
+
+def export_value(value):
+    """
+    Приводит значение из выгрузки к виду, пригодному для CSV и JSON.
+    """
+    if isinstance(value, datetime):
+        return value.strftime('%Y-%m-%d %H:%M:%S')
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    if value is not None and not isinstance(value, (int, str)):
+        return str(value)
+    return value
+
+CSV_FORMULA_PREFIXES = ('=', '+', '-', '@', '\t', '\r')
+
+def csv_safe_value(value):
+    """
+    Защищает ячейку CSV от выполнения как формулы в Excel: строка,
+    начинающаяся с =, +, -, @, табуляции или CR, получает префикс «'».
+    """
+    if isinstance(value, str) and value.startswith(CSV_FORMULA_PREFIXES):
+        return "'" + value
+    return value
+
+def iter_export_rows(filters):
+    """
+    Построчно читает выгрузку заказов пачками по EXPORT_BATCH_SIZE.
+
+    yield_per включает потоковое чтение результата, поэтому в памяти
+    одновременно находится не больше одной пачки строк.
+    """
+    result = db.session.execute(
+        export_orders_statement(filters).execution_options(yield_per=EXPORT_BATCH_SIZE)
+    )
+    try:
+        for row in result:
+            yield [export_value(value) for value in row]
+    finally:
+        result.close()
+
+def generate_orders_csv(filters):
+    """
+    Генератор CSV-выгрузки заказов (UTF-8 с BOM для Excel).
+
+    Строковые ячейки проходят через csv_safe_value(): имя и телефон вводят клиенты.
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    buffer.write('\ufeff')
+    writer.writerow(EXPORT_FIELDS)
+
+    for count, row in enumerate(iter_export_rows(filters), 1):
+        writer.writerow([csv_safe_value(value) for value in row])
+        if count % EXPORT_BATCH_SIZE == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+
+    yield buffer.getvalue()
+
+def generate_orders_ndjson(filters):
+    """
+    Генератор NDJSON-выгрузки заказов: один JSON-объект на строку.
+    """
+    for row in iter_export_rows(filters):
+        yield json.dumps(dict(zip(EXPORT_FIELDS, row)), ensure_ascii=False) + '\n'
+
+SEARCH_RESULTS_LIMIT = 30
+
+_search_index_ready = False
+
+SEARCH_TEXT_CONFIG = 'russian'
+
+def create_search_index():
+    """
+    Создаёт таблицу полнотекстового индекса, если её нет.
+
+    В SQLite это виртуальная таблица FTS5, в PostgreSQL — обычная таблица
+    с вычисляемым tsvector (заголовок с весом A, текст с весом B) и GIN-индексом.
+    Столбцы kind, item_id, title, body в обоих случаях одинаковые.
+    """
+    if not is_postgresql():
+        db.session.execute(text(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5("
+            "kind UNINDEXED, item_id UNINDEXED, title, body, "
+            "tokenize = 'unicode61 remove_diacritics 2')"
+        ))
+        return
+
+    db.session.execute(text(
+        "CREATE TABLE IF NOT EXISTS search_index ("
+        "kind VARCHAR(20) NOT NULL, item_id INTEGER NOT NULL, title TEXT NOT NULL, body TEXT NOT NULL, "
+        f"document tsvector GENERATED ALWAYS AS ("
+        f"setweight(to_tsvector('{SEARCH_TEXT_CONFIG}', title), 'A') || "
+        f"setweight(to_tsvector('{SEARCH_TEXT_CONFIG}', body), 'B')) STORED)"
+    ))
+    db.session.execute(text('CREATE INDEX IF NOT EXISTS ix_search_index_document ON search_index USING gin (document)'))
+    db.session.execute(text('CREATE INDEX IF NOT EXISTS ix_search_index_kind_item_id ON search_index (kind, item_id)'))
+
+def ensure_search_index():
+    """
+    Создаёт полнотекстовый индекс и заполняет его при первом запуске.
+
+    Дальше индекс поддерживается инкрементально обработчиками админ-панели
+    через index_search_document() и remove_search_document().
+    """
+    global _search_index_ready
+    if _search_index_ready:
+        return
+
+    create_search_index()
+
+    if db.session.execute(text('SELECT count(*) FROM search_index')).scalar() == 0:
+        documents = [('service', item.id, item.title, item.description) for item in Service.query.all()]
+        documents += [('news', item.id, item.title, item.content) for item in News.query.all()]
+        documents += [('portfolio', item.id, item.title, item.event_type or '') for item in Portfolio.query.all()]
+        if documents:
+            db.session.execute(
+                text('INSERT INTO search_index (kind, item_id, title, body) VALUES (:kind, :item_id, :title, :body)'),
+                [{'kind': kind, 'item_id': item_id, 'title': title, 'body': body}
+                 for kind, item_id, title, body in documents]
+            )
+        app.logger.info(f'Поисковый индекс построен: {len(documents)} документов')
+
+    db.session.commit()
+    _search_index_ready = True
+
+PUBLIC_PAGE_ENDPOINTS = {
+    'index', 'services', 'service_detail', 'portfolio', 'news', 'news_detail', 'about', 'search'
+}
+
+# Публичные страницы, которые по заголовкам запроса отдают HTML или JSON (см. wants_json).
+NEGOTIATED_PAGE_ENDPOINTS = {'portfolio', 'news', 'search'}
+
+@app.after_request
+def set_public_cache_headers(response):
+    """
+    Разрешает общий кэш (reverse proxy) для публичных страниц анонимных посетителей.
+
+    Страница считается общей, только если она не зависит от сессии:
+    пользователь не авторизован и в ответе не было flash-сообщений.
+    Счётчик корзины подгружается отдельно через /cart/count.
+    Для страниц с выбором HTML/JSON добавляется Vary по заголовкам,
+    от которых зависит формат, чтобы прокси не отдал JSON браузеру.
+    """
+    if request.endpoint in NEGOTIATED_PAGE_ENDPOINTS:
+        response.vary.update(('Accept', 'X-Requested-With', 'Content-Type'))
+
+    if request.method != 'GET' or response.status_code not in (200, 304) \
+            or request.endpoint not in PUBLIC_PAGE_ENDPOINTS or 'Cache-Control' in response.headers:
+        return response
+
+    if current_user.is_authenticated or session.modified:
+        response.headers['Cache-Control'] = 'private, no-cache'
+    else:
+        response.headers['Cache-Control'] = f"public, max-age={app.config['PUBLIC_CACHE_MAX_AGE']}"
+
+    return response
+
+slow_query_logger = logging.getLogger('gleeful.slow_sql')
+if app.config['SQL_SLOW_QUERY_LOG']:
+    slow_query_handler = logging.FileHandler(app.config['SQL_SLOW_QUERY_LOG'], encoding='utf-8')
+    slow_query_handler.setFormatter(logging.Formatter('[%(asctime)s] %(message)s'))
+    slow_query_logger.addHandler(slow_query_handler)
+    slow_query_logger.setLevel(logging.WARNING)
+
+SQL_PLACEHOLDER_LIST = re.compile(r'\((?:\s*(?:\?|%\(\w+\)s)\s*,)+\s*(?:\?|%\(\w+\)s)\s*\)')
+
+def statement_shape(statement):
+    """
+    Форма SQL-запроса для поиска повторов: списки параметров IN (?, ?, ...)
+    сворачиваются в (?), пробелы схлопываются.
+    """
+    return ' '.join(SQL_PLACEHOLDER_LIST.sub('(?)', statement).split())
+
+@app.before_request
+def start_sql_instrumentation():
+    """
+    Заводит счётчики SQL текущего запроса, если включён SQL_INSTRUMENTATION.
+    """
+    if app.config['SQL_INSTRUMENTATION']:
+        g.sql_stats = {'count': 0, 'time': 0.0, 'shapes': defaultdict(int)}
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def sql_before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    """
+    Запоминает время начала запроса на соединении.
+    """
+    if has_request_context() and 'sql_stats' in g:
+        conn.info['sql_started'] = time.perf_counter()
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def sql_after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    """
+    Учитывает выполненный запрос в статистике текущего HTTP-запроса
+    и пишет его в журнал медленных запросов, если он превысил SQL_SLOW_QUERY_MS.
+    """
+    started = conn.info.pop('sql_started', None)
+    if started is None or not (has_request_context() and 'sql_stats' in g):
+        return
+
+    elapsed = time.perf_counter() - started
+    stats = g.sql_stats
+    stats['count'] += 1
+    stats['time'] += elapsed
+    stats['shapes'][statement_shape(statement)] += 1
+
+    elapsed_ms = elapsed * 1000
+    if elapsed_ms >= app.config['SQL_SLOW_QUERY_MS']:
+        slow_query_logger.warning(f'Медленный запрос {elapsed_ms:.1f} мс в {request.endpoint}: '
+                                  f'{statement_shape(statement)}')
+
+@app.after_request
+def report_sql_instrumentation(response):
+    """
+    Итог по SQL для запроса: число запросов, суммарное время и формы запросов,
+    повторившиеся не меньше SQL_N_PLUS_ONE_THRESHOLD раз (вероятный N+1).
+
+    В режиме отладки итог отдаётся заголовками X-SQL-*, иначе пишется в лог.
+    Для потоковых ответов учитываются только запросы до начала передачи тела.
+    """
+    stats = g.pop('sql_stats', None)
+    if stats is None:
+        return response
+
+    repeated = {shape: count for shape, count in stats['shapes'].items()
+                if count >= app.config['SQL_N_PLUS_ONE_THRESHOLD']}
+    time_ms = stats['time'] * 1000
+
+    for shape, count in repeated.items():
+        app.logger.warning(f'Вероятный N+1 в {request.endpoint}: {count} одинаковых запросов: {shape[:300]}')
+
+    if app.debug:
+        response.headers['X-SQL-Queries'] = str(stats['count'])
+        response.headers['X-SQL-Time-ms'] = f'{time_ms:.1f}'
+        response.headers['X-SQL-N-Plus-One'] = str(len(repeated))
+    else:
+        app.logger.info(f'SQL {request.method} {request.endpoint}: {stats["count"]} запросов, '
+                        f'{time_ms:.1f} мс, повторов N+1: {len(repeated)}')
+
+    return response
+
+MIGRATIONS = []
+
+def migration(version, name):
+    """
+    Регистрирует функцию как миграцию схемы с номером версии.
+
+    Миграции выполняются по возрастанию версии, каждая в своей транзакции
+    вместе с записью в schema_migration. Они должны быть идемпотентными:
+    на новой базе db.create_all() уже создаёт всё по моделям.
+    """
+    def decorator(func):
+        MIGRATIONS.append((version, name, func))
+        return func
+    return decorator
+
+def add_column(table, column):
+    """
+    Добавляет в таблицу столбец (допускающий NULL), если его ещё нет.
+
+    Тип берётся из модели и компилируется под диалект текущей базы.
+    """
+    inspector = db.inspect(db.session.connection())
+    if not inspector.has_table(table):
+        return
+    if column in {existing['name'] for existing in inspector.get_columns(table)}:
+        return
+    column_type = db.metadata.tables[table].c[column].type.compile(dialect=db.engine.dialect)
+    db.session.execute(text(f'ALTER TABLE "{table}" ADD COLUMN "{column}" {column_type}'))
+    app.logger.info(f'Схема обновлена: добавлен столбец {table}.{column}')
+
+def create_index(name, table, *columns):
+    """
+    Создаёт индекс, если его ещё нет.
+    """
+    column_list = ', '.join(f'"{column}"' for column in columns)
+    db.session.execute(text(f'CREATE INDEX IF NOT EXISTS "{name}" ON "{table}" ({column_list})'))
+
+@migration(1, 'Столбцы updated_at у услуг, новостей и портфолио')
+def add_updated_at_columns():
+    for table in ('service', 'news', 'portfolio'):
+        add_column(table, 'updated_at')
+
+@migration(2, 'Индексы сортировки каталога, новостей, портфолио и заказов')
+def add_sort_indexes():
+    create_index('ix_service_price', 'service', 'price')
+    create_index('ix_service_category', 'service', 'category')
+    create_index('ix_news_date_posted', 'news', 'date_posted')
+    create_index('ix_portfolio_created_at', 'portfolio', 'created_at')
+    create_index('ix_order_date_created', 'order', 'date_created')
+    create_index('ix_order_event_date', 'order', 'event_date')
+    create_index('ix_order_user_id_date_created', 'order', 'user_id', 'date_created')
+
+@migration(3, 'Индексы внешних ключей и статуса заказов')
+def add_foreign_key_indexes():
+    # cart_item.user_id покрыт уникальным ограничением (user_id, service_id),
+    # order.user_id — составным индексом (user_id, date_created).
+    create_index('ix_order_status', 'order', 'status')
+    create_index('ix_order_item_order_id', 'order_item', 'order_id')
+    create_index('ix_order_item_service_id', 'order_item', 'service_id')
+
+def enable_sqlite_autoincrement(model, archive_model):
+    """
+    Пересоздаёт таблицу SQLite с AUTOINCREMENT, если он ещё не включён.
+
+    Без него SQLite выдаёт новой строке max(id) + 1, и после удаления
+    последних строк их id (уже занятые в архиве) выдавались бы повторно.
+    Данные копируются в новую таблицу, индексы создаются заново,
+    а счётчик sqlite_sequence поднимается выше максимального id архива.
+    """
+    if is_postgresql():
+        return
+
+    table = model.__table__
+    preparer = db.engine.dialect.identifier_preparer
+    table_name = preparer.format_table(table)
+    create_sql = db.session.execute(
+        text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = :name"), {'name': table.name}
+    ).scalar()
+
+    if create_sql and 'AUTOINCREMENT' not in create_sql.upper():
+        rebuild_name = preparer.quote(f'{table.name}_rebuild')
+        columns = ', '.join(preparer.quote(column.name) for column in table.columns)
+        db.session.execute(text(
+            str(CreateTable(table).compile(dialect=db.engine.dialect)).replace(table_name, rebuild_name, 1)
+        ))
+        db.session.execute(text(f'INSERT INTO {rebuild_name} ({columns}) SELECT {columns} FROM {table_name}'))
+        db.session.execute(text(f'DROP TABLE {table_name}'))
+        db.session.execute(text(f'ALTER TABLE {rebuild_name} RENAME TO {table_name}'))
+        for index in table.indexes:
+            index.create(db.session.connection())
+        app.logger.info(f'Схема обновлена: таблица {table.name} пересоздана с AUTOINCREMENT')
+
+    highest_id = max(db.session.query(func.max(model.id)).scalar() or 0,
+                     db.session.query(func.max(archive_model.id)).scalar() or 0)
+    updated = db.session.execute(
+        text('UPDATE sqlite_sequence SET seq = max(seq, :seq) WHERE name = :name'),
+        {'seq': highest_id, 'name': table.name}
+    ).rowcount
+    if not updated and highest_id:
+        db.session.execute(text('INSERT INTO sqlite_sequence (name, seq) VALUES (:name, :seq)'),
+                           {'name': table.name, 'seq': highest_id})
+
+@migration(4, 'AUTOINCREMENT для заказов и позиций: без повторного использования id из архива')
+def add_order_autoincrement():
+    enable_sqlite_autoincrement(Order, ArchivedOrder)
+    enable_sqlite_autoincrement(OrderItem, ArchivedOrderItem)
+
+@migration(5, 'BIGINT для site_stat.value: Unix-время не переполняется в 2038 году')
+def widen_site_stat_value():
+    # В SQLite INTEGER и так 64-битный, менять схему нужно только в PostgreSQL.
+    if is_postgresql():
+        db.session.execute(text('ALTER TABLE site_stat ALTER COLUMN value TYPE BIGINT'))
+
+def run_migrations():
+    """
+    Применяет к базе ещё не выполненные миграции из MIGRATIONS.
+
+    Версия записывается первой командой транзакции: второй процесс, начавший
+    ту же миграцию одновременно, дождётся блокировки, не сможет вставить
+    запись и пропустит миграцию. Возвращает список применённых версий.
+    """
+    applied = {version for version, in db.session.query(SchemaMigration.version)}
+    db.session.commit()
+
+    done = []
+    for version, name, upgrade in sorted(MIGRATIONS, key=lambda entry: entry[0]):
+        if version in applied:
+            continue
+        try:
+            claimed = db.session.execute(
+                upsert(SchemaMigration)
+                .values(version=version, name=name, applied_at=datetime.utcnow())
+                .on_conflict_do_nothing()
+            ).rowcount
+            if not claimed:
+                db.session.rollback()
+                continue
+            upgrade()
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        app.logger.info(f'Применена миграция {version}: {name}')
+        done.append(version)
+    return done
+
+def init_database():
+    """
+    Создаёт недостающие таблицы, применяет миграции и готовит поисковый индекс.
+    """
+    db.create_all()
+    run_migrations()
+    ensure_search_index()
+
+    settings = sqlite_settings_report()
+    if settings:
+        app.logger.info('Настройки SQLite: ' + ', '.join(f'{name}={value}' for name, value in settings.items()))
+
+_database_prepared = False
+
+@app.before_request
+def prepare_database():
+    """
+    Один раз на процесс выполняет init_database() до первого запроса.
+    """
+    global _database_prepared
+    if _database_prepared:
+        return
+
+    try:
+        init_database()
+        _database_prepared = True
+    except Exception as e:
+        db.session.rollback()
+        app.logger.error(f'Ошибка при подготовке базы данных: {str(e)}')
+
+def index_search_document(kind, item_id, title, body):
+    """
+    Добавляет или обновляет документ в поисковом индексе.
+
+    Выполняется в текущей транзакции, поэтому индекс фиксируется
+    вместе с изменением самой записи.
+    """
+    remove_search_document(kind, item_id)
+    db.session.execute(
+        text('INSERT INTO search_index (kind, item_id, title, body) VALUES (:kind, :item_id, :title, :body)'),
+        {'kind': kind, 'item_id': item_id, 'title': title, 'body': body or ''}
+    )
+
+def remove_search_document(kind, item_id):
+    """
+    Удаляет документ из поискового индекса в текущей транзакции.
+    """
+    db.session.execute(
+        text('DELETE FROM search_index WHERE kind = :kind AND item_id = :item_id'),
+        {'kind': kind, 'item_id': item_id}
+    )
+
+def build_search_query(query_string):
+    """
+    Превращает пользовательский ввод в безопасное выражение FTS5 MATCH
+    (или tsquery для PostgreSQL).
+
+    Каждое слово ищется по префиксу, все слова обязательны.
+    """
+    words = re.findall(r'\w+', query_string)[:10]
+    if is_postgresql():
+        return ' & '.join(f'{word}:*' for word in words)
+    return ' '.join(f'"{word}"*' for word in words)
+
+def highlight_snippet(snippet):
+    """
+    Экранирует найденный фрагмент и заменяет служебные маркеры на <mark>.
+    """
+    return Markup(str(escape(snippet)).replace('\x02', '<mark>').replace('\x03', '</mark>'))
+
+def search_documents(query_string, limit=SEARCH_RESULTS_LIMIT):
+    """
+    Ищет услуги, новости и работы портфолио по полнотекстовому индексу.
+
+    Результаты упорядочены по релевантности (bm25 в SQLite, ts_rank в PostgreSQL),
+    совпадения в заголовке весят больше.
+    """
+    match = build_search_query(query_string)
+    if not match:
+        return []
+
+    if is_postgresql():
+        rows = db.session.execute(text(
+            "SELECT kind, item_id, "
+            "ts_headline(:config, title, query, :title_options) AS title, "
+            "ts_headline(:config, body, query, :snippet_options) AS snippet "
+            "FROM search_index, to_tsquery(:config, :match) AS query "
+            "WHERE document @@ query "
+            "ORDER BY ts_rank(document, query) DESC LIMIT :limit"
+        ), {'config': SEARCH_TEXT_CONFIG, 'match': match, 'limit': limit,
+            'title_options': 'StartSel=\x02, StopSel=\x03, HighlightAll=true',
+            'snippet_options': 'StartSel=\x02, StopSel=\x03, MaxWords=16, MinWords=8, FragmentDelimiter=…'}).all()
+    else:
+        rows = db.session.execute(text(
+            "SELECT kind, item_id, "
+            "highlight(search_index, 2, char(2), char(3)) AS title, "
+            "snippet(search_index, 3, char(2), char(3), '…', 16) AS snippet "
+            "FROM search_index WHERE search_index MATCH :match "
+            "ORDER BY bm25(search_index, 0.0, 0.0, 10.0, 1.0) LIMIT :limit"
+        ), {'match': match, 'limit': limit}).all()
+
+    endpoints = {'service': 'service_detail', 'news': 'news_detail', 'portfolio': 'portfolio'}
+    results = []
+    for kind, item_id, title, snippet in rows:
+        item_id = int(item_id)
+        url = url_for(endpoints[kind]) if kind == 'portfolio' else url_for(endpoints[kind], id=item_id)
+        results.append({
+            'kind': kind,
+            'id': item_id,
+            'title': highlight_snippet(title),
+            'snippet': highlight_snippet(snippet),
+            'url': url
+        })
+    return results
+
+class Cart:
+    """
+    Корзина текущего пользователя в пределах одного запроса.
+
+    Загружается одним запросом вместе с услугами и хранится в flask.g,
+    поэтому значок, страница корзины и оформление заказа работают с одними
+    и теми же данными. Методы add/remove/clear меняют базу или сессию
+    и сразу обновляют загруженное состояние; фиксирует транзакцию вызывающий код.
+
+    Позиции и услуги выбираются одним запросом, а итоговая сумма считается
+    по загруженным услугам, поэтому число запросов не зависит от размера корзины.
+    """
+
+    def __init__(self, user_id=None):
+        self.user_id = user_id
+        self._entries = None
+
+    @property
+    def is_guest(self):
+        return self.user_id is None
+
+    @property
+    def entries(self):
+        """
+        Список (service_id, Service или None, CartItem или None) в порядке добавления.
+        """
+        if self._entries is None:
+            if self.is_guest:
+                cart_ids = list(dict.fromkeys(session.get('cart', [])))
+                rows = []
+                if cart_ids:
+                    rows = Service.query.filter(Service.id.in_(cart_ids)).all()
+                services = {service.id: service for service in rows}
+                self._entries = [(service_id, services.get(service_id), None) for service_id in cart_ids]
+            else:
+                rows = db.session.query(CartItem, Service)\
+                                 .outerjoin(Service, CartItem.service_id == Service.id)\
+                                 .filter(CartItem.user_id == self.user_id)\
+                                 .order_by(CartItem.added_at, CartItem.id)\
+                                 .all()
+                self._entries = [(item.service_id, service, item) for item, service in rows]
+        return self._entries
+
+    @property
+    def services(self):
+        return [service for _, service, _ in self.entries if service is not None]
+
+    @property
+    def count(self):
+        if self.is_guest and self._entries is None:
+            return len(session.get('cart', []))
+        return len(self.services)
+
+    @property
+    def total(self):
+        return sum(service.price for service in self.services)
+
+    def contains(self, service_id):
+        if self.is_guest and self._entries is None:
+            return service_id in session.get('cart', [])
+        return any(entry_id == service_id for entry_id, _, _ in self.entries)
+
+    def add(self, service):
+        """
+        Добавляет услугу в корзину.
+        """
+        if self.is_guest:
+            session['cart'] = session.get('cart', []) + [service.id]
+            session.modified = True
+            item = None
+        else:
+            item = CartItem(user_id=self.user_id, service_id=service.id)
+            db.session.add(item)
+
+        if self._entries is not None:
+            self._entries.append((service.id, service, item))
+
+    def remove(self, service_id):
+        """
+        Удаляет услугу из корзины. Возвращает False, если её там не было.
+        """
+        if self.is_guest:
+            cart_ids = session.get('cart', [])
+            if service_id not in cart_ids:
+                return False
+            session['cart'] = [id_ for id_ in cart_ids if id_ != service_id]
+            session.modified = True
+        else:
+            items = [item for entry_id, _, item in self.entries if entry_id == service_id]
+            if not items:
+                return False
+            for item in items:
+                db.session.delete(item)
+
+        if self._entries is not None:
+            self._entries = [entry for entry in self._entries if entry[0] != service_id]
+        return True
 
-    """
+    def clear(self):
+        """
+        Очищает корзину. Возвращает количество удалённых позиций.
+        """
+        if self.is_guest:
+            removed = len(session.get('cart', []))
+            session['cart'] = []
+            session.modified = True
+        else:
+            removed = CartItem.query.filter_by(user_id=self.user_id).delete()
 
-    id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    total_price = db.Column(db.Numeric(10, 2), nullable=False)
-    status = db.Column(db.String(50), default='Новый', nullable=False)
-    contact_phone = db.Column(db.String(20), nullable=False)
-    event_date = db.Column(db.Date, nullable=False)
-    date_created = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+        self._entries = []
+        return removed
 
-    order_items = db.relationship('OrderItem', backref='order', lazy=True, cascade='all, delete-orphan')
+    def prune(self):
+        """
+        Убирает позиции с удалёнными услугами и дубликаты.
 
-    def __repr__(self):
-        return f'<Order {self.id}>'
+        Возвращает пару (число удалённых услуг, число дубликатов).
+        """
+        valid = []
+        seen_service_ids = set()
+        missing = duplicates = 0
+
+        for service_id, service, item in self.entries:
+            if service is None:
+                missing += 1
+            elif service_id in seen_service_ids:
+                duplicates += 1
+                if item is not None:
+                    app.logger.warning(f'Дубликат CartItem {item.id} для user {item.user_id}, service {item.service_id} - удалён')
+            else:
+                valid.append((service_id, service, item))
+                seen_service_ids.add(service_id)
+                continue
 
-class OrderItem(db.Model):
-    """
-    Позиции в заказе.
+            if item is not None:
+                db.session.delete(item)
 
-    """
+        if self.is_guest:
+            duplicates = len(session.get('cart', [])) - len(self.entries)
+            if missing or duplicates:
+                session['cart'] = [service_id for service_id, _, _ in valid]
+                session.modified = True
 
-    id = db.Column(db.Integer, primary_key=True)
-    order_id = db.Column(db.Integer, db.ForeignKey('order.id'), nullable=False)
-    service_id = db.Column(db.Integer, db.ForeignKey('service.id'), nullable=False)
-    price_at_moment = db.Column(db.Numeric(10, 2), nullable=False)
+        self._entries = valid
+        return missing, duplicates
 
-    def __repr__(self):
-        return f'<OrderItem Order:{self.order_id} Service:{self.service_id}>'
+def get_cart():
+    """
+    Возвращает корзину текущего пользователя, загруженную не более одного раза за запрос.
+    """
+    user_id = current_user.id if current_user.is_authenticated else None
+    cart = g.get('cart')
+    if cart is None or cart.user_id != user_id:
+        cart = g.cart = Cart(user_id)
+    return cart
 
 def get_cart_count():
     """
     Возвращает количество товаров в корзине текущего пользователя.
 
     """
-    if current_user.is_authenticated:
-        return CartItem.query.filter_by(user_id=current_user.id).count()
-    else:
-        return len(session.get('cart', []))
+    return get_cart().count
 
 def get_cart_items():
     """
     Возвращает список услуг в корзине текущего пользователя.
 
     """
-    if current_user.is_authenticated:
-        cart_items = CartItem.query.filter_by(user_id=current_user.id).all()
-        return [ci.service for ci in cart_items if ci.service]
-    else:
-        cart_ids = session.get('cart', [])
-        if not cart_ids:
-            return []
-        return Service.query.filter(Service.id.in_(cart_ids)).all()
+    return get_cart().services
 
 def get_cart_total():
     """
     Вычисляет общую стоимость товаров в корзине..
     """
-    cart_items = get_cart_items()
-    return sum(item.price for item in cart_items)
+    return get_cart().total
 
 def merge_cart_to_user(user):
     """
     Переносит товары из сессионной корзины в корзину авторизованного пользователя.
+
+    Существующие услуги выбираются одним запросом IN, а позиции вставляются
+    одним INSERT ... ON CONFLICT DO NOTHING: уже лежащие в корзине услуги
+    отсекает ограничение unique_user_service.
     """
     try:
-        session_cart_ids = session.get('cart', [])
+        session_cart_ids = list(dict.fromkeys(session.get('cart', [])))
 
         if not session_cart_ids:
             return 0
 
-        existing_cart_service_ids = [
-            ci.service_id for ci in CartItem.query.filter_by(user_id=user.id).all()
+        valid_ids = [
+            service_id for (service_id,) in
+            db.session.query(Service.id).filter(Service.id.in_(session_cart_ids)).all()
         ]
 
         added_count = 0
-        for service_id in session_cart_ids:
-            service = Service.query.get(service_id)
-            if not service:
-                continue
-
-            if service_id not in existing_cart_service_ids:
-                cart_item = CartItem(
-                    user_id=user.id,
-                    service_id=service_id
-                )
-                db.session.add(cart_item)
-                added_count += 1
+        if valid_ids:
+            now = datetime.utcnow()
+            statement = upsert(CartItem.__table__).values([
+                {'user_id': user.id, 'service_id': service_id, 'added_at': now}
+                for service_id in valid_ids
+            ]).on_conflict_do_nothing(index_elements=['user_id', 'service_id'])
+            added_count = db.session.execute(statement).rowcount
+            g.pop('cart', None)
 
         if added_count > 0:
             db.session.commit()
@@ -243,6 +2325,7 @@ def merge_cart_to_user(user):
 
     except Exception as e:
         db.session.rollback()
+        g.pop('cart', None)
         app.logger.error(f'Ошибка при слиянии корзины: {str(e)}')
         return 0
 
@@ -267,6 +2350,8 @@ def load_user(user_id):
         return None
 
 @app.route('/')
+@conditional_page(catalog_validators)
+@cached_page('services')
 def index():
     """
     Главная страница сайта.
@@ -275,67 +2360,133 @@ def index():
 
     """
     try:
-        services = Service.query.limit(3).all()
+        services = get_catalog()['services'][:3]
         return render_template('index.html', services=services)
     except Exception as e:
         app.logger.error(f'Ошибка на главной странице: {str(e)}')
         return render_template('index.html', services=[])
 
 @app.route('/services')
+@conditional_page(catalog_validators)
+@cached_page('services')
 def services():
     """
     Страница каталога услуг.
 
-    Отображает полный список всех доступных услуг.
+    Поддерживает фильтрацию по категории и диапазону цен, сортировку
+    и постраничный вывод. Фильтры вычисляются в SQL по индексам
+    service.category и service.price; запрос без параметров отдаётся
+    из снимка каталога без обращения к базе.
     """
+    filters = get_service_filters(request.args)
+    page, per_page = filters['page'], filters['per_page']
+
     try:
-        services = Service.query.all()
-        return render_template('services.html', services=services)
+        is_default = not filters['category'] and filters['min_price'] is None \
+            and filters['max_price'] is None and filters['sort'] == 'default'
+
+        if is_default:
+            catalog = get_catalog()['services']
+            total = len(catalog)
+            services = catalog[(page - 1) * per_page:page * per_page]
+        else:
+            query = Service.query
+            if filters['category']:
+                query = query.filter(Service.category.in_(SERVICE_CATEGORIES[filters['category']]))
+            if filters['min_price'] is not None:
+                query = query.filter(Service.price >= filters['min_price'])
+            if filters['max_price'] is not None:
+                query = query.filter(Service.price <= filters['max_price'])
+            query = query.order_by(*SERVICE_SORTS[filters['sort']])
+
+            pagination = query.paginate(page=page, per_page=per_page, error_out=False)
+            total = pagination.total
+            services = pagination.items
+
+        pages = max((total + per_page - 1) // per_page, 1)
+        return render_template('services.html', services=services, filters=filters,
+                               total=total, page=page, pages=pages)
     except Exception as e:
         app.logger.error(f'Ошибка при загрузке каталога услуг: {str(e)}')
-        return render_template('services.html', services=[])
+        return render_template('services.html', services=[], filters=filters,
+                               total=0, page=1, pages=1)
 
 @app.route('/service/<int:id>')
+@conditional_page(service_validators)
+@cached_page('services')
 def service_detail(id):
     """
     Страница детальной информации об услуге.
 
     """
     try:
-        service = Service.query.get_or_404(id)
+        service = get_catalog()['by_id'].get(id)
+        if service is None:
+            abort(404)
         return render_template('service_detail.html', service=service)
     except Exception as e:
         app.logger.error(f'Ошибка при загрузке деталей услуги {id}: {str(e)}')
         abort(404)
 
 @app.route('/portfolio')
+@conditional_page(portfolio_validators)
+@cached_page('portfolio')
 def portfolio():
     """
     Страница портфолио агентства.
 
+    Работы выводятся страницами по курсору (?cursor=...),
+    при запросе JSON возвращается страница и курсор следующей.
     """
+    cursor = request.args.get('cursor')
     try:
-        portfolio_items = Portfolio.query.order_by(Portfolio.created_at.desc()).all()
-        return render_template('portfolio.html', portfolio_items=portfolio_items)
+        portfolio_items, next_cursor = keyset_page(
+            Portfolio.query, Portfolio.created_at, Portfolio.id, cursor, PORTFOLIO_PER_PAGE
+        )
+        if wants_json():
+            return jsonify({
+                'items': [portfolio_to_dict(item) for item in portfolio_items],
+                'next_cursor': next_cursor
+            })
+        return render_template('portfolio.html', portfolio_items=portfolio_items,
+                               next_cursor=next_cursor, cursor=cursor)
     except Exception as e:
         app.logger.error(f'Ошибка при загрузке портфолио: {str(e)}')
-        return render_template('portfolio.html', portfolio_items=[])
+        if wants_json():
+            return jsonify({'items': [], 'next_cursor': None})
+        return render_template('portfolio.html', portfolio_items=[], next_cursor=None, cursor=None)
 
 @app.route('/news')
+@conditional_page(news_list_validators)
+@cached_page('news')
 def news():
     """
     Страница списка новостей.
 
-    Отображает все новости в обратном хронологическом порядке.
+    Отображает новости в обратном хронологическом порядке страницами
+    по курсору (?cursor=...), при запросе JSON возвращает страницу и курсор следующей.
     """
+    cursor = request.args.get('cursor')
     try:
-        news_list = News.query.order_by(News.date_posted.desc()).all()
-        return render_template('news.html', news_list=news_list)
+        news_list, next_cursor = keyset_page(
+            News.query, News.date_posted, News.id, cursor, NEWS_PER_PAGE
+        )
+        if wants_json():
+            return jsonify({
+                'items': [news_to_dict(item) for item in news_list],
+                'next_cursor': next_cursor
+            })
+        return render_template('news.html', news_list=news_list,
+                               next_cursor=next_cursor, cursor=cursor)
     except Exception as e:
         app.logger.error(f'Ошибка при загрузке новостей: {str(e)}')
-        return render_template('news.html', news_list=[])
+        if wants_json():
+            return jsonify({'items': [], 'next_cursor': None})
+        return render_template('news.html', news_list=[], next_cursor=None, cursor=None)
 
 @app.route('/news/<int:id>')
+@conditional_page(news_validators)
+@cached_page('news')
 def news_detail(id):
     """
     Страница детальной информации о новости.
@@ -348,6 +2499,7 @@ def news_detail(id):
         abort(404)
 
 @app.route('/about')
+@cached_page()
 def about():
     """
     Страница "О нас".
@@ -356,6 +2508,32 @@ def about():
     """
     return render_template('about.html')
 
+@app.route('/search')
+def search():
+    """
+    Полнотекстовый поиск по услугам, новостям и портфолио.
+
+    Параметр ?q=... задаёт поисковый запрос; при запросе JSON
+    возвращает список найденных документов со сниппетами.
+    """
+    query_string = request.args.get('q', '').strip()[:200]
+
+    try:
+        results = search_documents(query_string)
+    except Exception as e:
+        db.session.rollback()
+        app.logger.error(f'Ошибка при поиске "{query_string}": {str(e)}')
+        results = []
+
+    if wants_json():
+        return jsonify({
+            'query': query_string,
+            'results': [dict(result, title=str(result['title']), snippet=str(result['snippet']))
+                        for result in results]
+        })
+
+    return render_template('search.html', query=query_string, results=results)
+
 @app.route('/contacts', methods=['GET', 'POST'])
 def contacts():
     """
@@ -533,6 +2711,7 @@ def register():
             user.set_password(password)
 
             db.session.add(user)
+            bump_stat('total_users')
             db.session.commit()
 
             flash(f'Добро пожаловать в Gleeful, {username}! Регистрация успешна.', 'success')
@@ -569,6 +2748,31 @@ def logout():
 
     return redirect(url_for('index'))
 
+def cart_response(success, message, category, redirect_to):
+    """
+    Ответ обработчиков корзины.
+
+    Для JSON-запросов (Accept или X-Requested-With) возвращает новое состояние
+    корзины, чтобы страница обновилась без перезагрузки; иначе ставит
+    flash-сообщение и перенаправляет.
+    """
+    if wants_json():
+        payload = {'success': success, 'message': message}
+        if success:
+            # После commit загруженные объекты устарели: одна перезагрузка вместо обновления каждого
+            g.pop('cart', None)
+            cart = get_cart()
+            payload.update({
+                'cart_count': cart.count,
+                'total': float(cart.total),
+                'items': [{'id': service.id, 'title': service.title, 'price': float(service.price)}
+                          for service in cart.services]
+            })
+        return jsonify(payload)
+
+    flash(message, category)
+    return redirect(redirect_to)
+
 @app.route('/cart/add/<int:id>', methods=['POST'])
 def add_to_cart(id):
     """
@@ -576,48 +2780,47 @@ def add_to_cart(id):
     """
     try:
         service = Service.query.get_or_404(id)
+        cart = get_cart()
 
-        if current_user.is_authenticated:
-            existing_item = CartItem.query.filter_by(
-                user_id=current_user.id,
-                service_id=id
-            ).first()
+        if cart.contains(id):
+            message, category = f'Услуга "{service.title}" уже в корзине!', 'info'
+        else:
+            cart.add(service)
 
-            if existing_item:
-                flash(f'Услуга "{service.title}" уже в корзине!', 'info')
-            else:
-                cart_item = CartItem(
-                    user_id=current_user.id,
-                    service_id=id
-                )
-                db.session.add(cart_item)
+            if current_user.is_authenticated:
                 db.session.commit()
-
-                flash(f'Услуга "{service.title}" добавлена в корзину!', 'success')
                 app.logger.info(f'Пользователь {current_user.username} добавил услугу {id} в корзину')
-        else:
-            if 'cart' not in session:
-                session['cart'] = []
-
-            cart_ids = session.get('cart', [])
-
-            if id not in cart_ids:
-                session['cart'].append(id)
-                session.modified = True
-
-                flash(f'Услуга "{service.title}" добавлена в корзину!', 'success')
-                app.logger.info(f'Анонимный пользователь добавил услугу {id} в корзину')
             else:
-                flash(f'Услуга "{service.title}" уже в корзине!', 'info')
+                app.logger.info(f'Анонимный пользователь добавил услугу {id} в корзину')
 
-        return redirect(request.referrer or url_for('services'))
+            message, category = f'Услуга "{service.title}" добавлена в корзину!', 'success'
+
+        return cart_response(True, message, category, request.referrer or url_for('services'))
 
     except Exception as e:
         if current_user.is_authenticated:
             db.session.rollback()
+        g.pop('cart', None)
         app.logger.error(f'Ошибка при добавлении в корзину: {str(e)}')
-        flash('Произошла ошибка при добавлении в корзину', 'error')
-        return redirect(request.referrer or url_for('services'))
+        return cart_response(False, 'Произошла ошибка при добавлении в корзину', 'error',
+                             request.referrer or url_for('services'))
+
+@app.route('/cart/count')
+def cart_count():
+    """
+    Количество товаров в корзине для значка в шапке сайта.
+
+    Вынесено из рендера страниц, чтобы публичные страницы не зависели от пользователя.
+    """
+    try:
+        count = get_cart_count()
+    except Exception as e:
+        app.logger.error(f'Ошибка при подсчёте корзины: {str(e)}')
+        count = 0
+
+    response = jsonify({'count': count})
+    response.headers['Cache-Control'] = 'private, no-store'
+    return response
 
 @app.route('/cart')
 def cart():
@@ -628,49 +2831,20 @@ def cart():
     Очищает недействительные записи и дубликаты.
     """
     try:
-        if current_user.is_authenticated:
-            cart_items_query = CartItem.query.filter_by(user_id=current_user.id).all()
-
-            valid_items = []
-            seen_service_ids = set()
-            for item in cart_items_query:
-                if item.service:
-                    if item.service_id not in seen_service_ids:
-                        valid_items.append(item)
-                        seen_service_ids.add(item.service_id)
-                    else:
-                        app.logger.warning(f'Дубликат CartItem {item.id} для user {item.user_id}, service {item.service_id} - удалён')
-                        db.session.delete(item)
-                else:
-                    db.session.delete(item)
+        cart = get_cart()
+        missing, duplicates = cart.prune()
 
-            if valid_items:
+        if current_user.is_authenticated:
+            if missing or duplicates:
                 db.session.commit()
-
-            cart_items = [item.service for item in valid_items]
         else:
-            cart_ids = session.get('cart', [])
-
-            if not cart_ids:
-                cart_items = []
-            else:
-                unique_cart_ids = list(dict.fromkeys(cart_ids))
-                if len(unique_cart_ids) < len(cart_ids):
-                    session['cart'] = unique_cart_ids
-                    session.modified = True
-                    app.logger.info(f'Убраны дубликаты из сессии: {len(cart_ids)} -> {len(unique_cart_ids)}')
+            if duplicates:
+                app.logger.info(f'Убраны дубликаты из сессии: {duplicates}')
+            if missing:
+                flash('Некоторые услуги из корзины были удалены', 'warning')
 
-                cart_items = Service.query.filter(Service.id.in_(unique_cart_ids)).all()
-
-                found_ids = [item.id for item in cart_items]
-                missing_ids = set(unique_cart_ids) - set(found_ids)
-
-                if missing_ids:
-                    session['cart'] = [id_ for id_ in unique_cart_ids if id_ in found_ids]
-                    session.modified = True
-                    flash('Некоторые услуги из корзины были удалены', 'warning')
-
-        total = sum(item.price for item in cart_items) if cart_items else 0
+        cart_items = cart.services
+        total = cart.total if cart_items else 0
 
         return render_template('cart.html', cart_items=cart_items, total=total)
 
@@ -689,41 +2863,25 @@ def remove_from_cart(id):
     try:
         service = Service.query.get_or_404(id)
 
-        if current_user.is_authenticated:
-            cart_item = CartItem.query.filter_by(
-                user_id=current_user.id,
-                service_id=id
-            ).first()
-
-            if cart_item:
-                db.session.delete(cart_item)
+        if get_cart().remove(id):
+            if current_user.is_authenticated:
                 db.session.commit()
-
-                flash(f'Услуга "{service.title}" удалена из корзины', 'success')
                 app.logger.info(f'Пользователь {current_user.username} удалил услугу {id} из корзины')
             else:
-                flash('Этой услуги нет в вашей корзине', 'warning')
-        else:
-            cart_ids = session.get('cart', [])
-
-            if id in cart_ids:
-                cart_ids.remove(id)
-                session['cart'] = cart_ids
-                session.modified = True
-
-                flash(f'Услуга "{service.title}" удалена из корзины', 'success')
                 app.logger.info(f'Анонимный пользователь удалил услугу {id} из корзины')
-            else:
-                flash('Этой услуги нет в вашей корзине', 'warning')
 
-        return redirect(url_for('cart'))
+            message, category = f'Услуга "{service.title}" удалена из корзины', 'success'
+        else:
+            message, category = 'Этой услуги нет в вашей корзине', 'warning'
+
+        return cart_response(True, message, category, url_for('cart'))
 
     except Exception as e:
         if current_user.is_authenticated:
             db.session.rollback()
+        g.pop('cart', None)
         app.logger.error(f'Ошибка при удалении из корзины: {str(e)}')
-        flash('Произошла ошибка при удалении из корзины', 'error')
-        return redirect(url_for('cart'))
+        return cart_response(False, 'Произошла ошибка при удалении из корзины', 'error', url_for('cart'))
 
 @app.route('/cart/clear', methods=['POST'])
 def clear_cart():
@@ -733,29 +2891,63 @@ def clear_cart():
     Удаляет все услуги из корзины текущего пользователя.
     """
     try:
+        cart_count = get_cart().clear()
+
         if current_user.is_authenticated:
-            cart_count = CartItem.query.filter_by(user_id=current_user.id).count()
-            CartItem.query.filter_by(user_id=current_user.id).delete()
             db.session.commit()
-
-            flash(f'Корзина очищена. Удалено услуг: {cart_count}', 'success')
             app.logger.info(f'Пользователь {current_user.username} очистил корзину')
         else:
-            cart_count = len(session.get('cart', []))
-            session['cart'] = []
-            session.modified = True
-
-            flash(f'Корзина очищена. Удалено услуг: {cart_count}', 'success')
             app.logger.info(f'Анонимный пользователь очистил корзину')
 
-        return redirect(url_for('cart'))
+        return cart_response(True, f'Корзина очищена. Удалено услуг: {cart_count}', 'success', url_for('cart'))
 
     except Exception as e:
         if current_user.is_authenticated:
             db.session.rollback()
+        g.pop('cart', None)
         app.logger.error(f'Ошибка при очистке корзины: {str(e)}')
-        flash('Произошла ошибка при очистке корзины', 'error')
-        return redirect(url_for('cart'))
+        return cart_response(False, 'Произошла ошибка при очистке корзины', 'error', url_for('cart'))
+
+@app.route('/calendar')
+@login_required
+def booking_calendar():
+    """
+    Календарь занятости по дням за период для формы оформления заказа.
+
+    Параметры date_from и date_to (ГГГГ-ММ-ДД), по умолчанию — текущий месяц.
+    Если задана DAILY_EVENT_CAPACITY, для каждого дня возвращается остаток мест.
+    Число мероприятий по дням видят только администраторы.
+    """
+    today = datetime.now().date()
+    try:
+        date_from = datetime.strptime(request.args.get('date_from', ''), '%Y-%m-%d').date() \
+            if request.args.get('date_from') else month_start(today)
+        date_to = datetime.strptime(request.args.get('date_to', ''), '%Y-%m-%d').date() \
+            if request.args.get('date_to') else next_month_start(date_from) - timedelta(days=1)
+    except ValueError:
+        return jsonify({'success': False, 'message': 'Неверный формат даты. Используйте ГГГГ-ММ-ДД'}), 400
+
+    if date_to < date_from or (date_to - date_from).days >= CALENDAR_MAX_DAYS:
+        return jsonify({'success': False, 'message': f'Период должен быть не длиннее {CALENDAR_MAX_DAYS} дней'}), 400
+
+    try:
+        bookings = get_bookings(date_from, date_to)
+    except Exception as e:
+        app.logger.error(f'Ошибка при загрузке календаря занятости: {str(e)}')
+        return jsonify({'success': False, 'message': 'Произошла ошибка при загрузке календаря'})
+
+    capacity = app.config['DAILY_EVENT_CAPACITY'] or None
+    days = []
+    day = date_from
+    while day <= date_to:
+        booked = bookings.get(day, 0)
+        entry = {'date': day.isoformat(), 'available': max(capacity - booked, 0) if capacity else None}
+        if current_user.is_admin:
+            entry['bookings'] = booked
+        days.append(entry)
+        day += timedelta(days=1)
+
+    return jsonify({'success': True, 'capacity': capacity, 'days': days})
 
 @app.route('/checkout', methods=['GET', 'POST'])
 @login_required
@@ -769,21 +2961,21 @@ def checkout():
     try:
         merge_cart_to_user(current_user)
 
-        cart_items_query = CartItem.query.filter_by(user_id=current_user.id).all()
+        cart = get_cart()
 
-        if not cart_items_query:
+        if not cart.entries:
             flash('Ваша корзина пуста! Добавьте услуги перед оформлением заказа.', 'error')
             return redirect(url_for('services'))
 
-        cart_items = [item.service for item in cart_items_query if item.service]
+        cart_items = cart.services
 
         if not cart_items:
             flash('Корзина пуста или услуги недоступны', 'error')
-            CartItem.query.filter_by(user_id=current_user.id).delete()
+            cart.clear()
             db.session.commit()
             return redirect(url_for('services'))
 
-        total = sum(item.price for item in cart_items)
+        total = cart.total
 
         if request.method == 'POST':
             contact_phone = request.form.get('contact_phone', '').strip()
@@ -813,6 +3005,16 @@ def checkout():
                     flash(error, 'error')
                 return render_template('checkout.html', cart_items=cart_items, total=total)
 
+            capacity = app.config['DAILY_EVENT_CAPACITY']
+            if capacity > 0:
+                lock_event_date(event_date)
+            if capacity > 0 and get_bookings(event_date, event_date, fresh=True).get(event_date, 0) >= capacity:
+                if app.config['CAPACITY_POLICY'] == 'block':
+                    db.session.rollback()
+                    flash(f'На {event_date.strftime("%d.%m.%Y")} все места уже заняты. Пожалуйста, выберите другую дату.', 'error')
+                    return render_template('checkout.html', cart_items=cart_items, total=total)
+                flash(f'На {event_date.strftime("%d.%m.%Y")} уже много мероприятий — менеджер уточнит возможность проведения.', 'warning')
+
             try:
                 order = Order(
                     user_id=current_user.id,
@@ -833,9 +3035,15 @@ def checkout():
                     )
                     db.session.add(order_item)
 
-                CartItem.query.filter_by(user_id=current_user.id).delete()
+                cart.clear()
 
+                bump_stat('total_orders')
+                bump_stat('new_orders')
+                db.session.flush()
+                record_order_event('order_created', order.id, get_admin_row('orders', order.id))
                 db.session.commit()
+                invalidate_bookings(event_date)
+                order_event_broker.notify()
 
                 flash(f'Заказ №{order.id} успешно оформлен! Мы свяжемся с вами в ближайшее время.', 'success')
                 app.logger.info(f'Пользователь {current_user.username} оформил заказ {order.id} на сумму {total}')
@@ -862,31 +3070,19 @@ def profile():
     """
     Личный кабинет пользователя.
 
-    Отображает профиль пользователя с историей его заказов.
+    Отображает профиль пользователя с историей его заказов (страницами по курсору).
     """
     try:
-        orders = Order.query.filter_by(user_id=current_user.id)\
-                           .order_by(Order.date_created.desc())\
-                           .all()
-
-        orders_with_items = []
-        for order in orders:
-            order_items = db.session.query(OrderItem, Service)\
-                                  .join(Service, OrderItem.service_id == Service.id)\
-                                  .filter(OrderItem.order_id == order.id)\
-                                  .all()
-
-            orders_with_items.append({
-                'order': order,
-                'order_items': order_items
-            })
-
-        return render_template('profile.html', orders=orders_with_items)
+        include_archive = request.args.get('archive') == '1'
+        orders, next_cursor = load_order_history(current_user.id, request.args.get('cursor'),
+                                                 include_archive=include_archive)
+        return render_template('profile.html', orders=orders, next_cursor=next_cursor,
+                               cursor=request.args.get('cursor'), archive=include_archive)
 
     except Exception as e:
         app.logger.error(f'Ошибка при загрузке профиля пользователя {current_user.username}: {str(e)}')
         flash('Произошла ошибка при загрузке профиля', 'error')
-        return render_template('profile.html', orders=[])
+        return render_template('profile.html', orders=[], next_cursor=None, cursor=None)
 
 @app.route('/my-orders')
 @login_required
@@ -894,31 +3090,19 @@ def my_orders():
     """
     Страница заказов пользователя.
 
-    Отображает список всех заказов текущего пользователя с деталями.
+    Отображает заказы текущего пользователя с деталями (страницами по курсору).
     """
     try:
-        orders = Order.query.filter_by(user_id=current_user.id)\
-                           .order_by(Order.date_created.desc())\
-                           .all()
-
-        orders_with_items = []
-        for order in orders:
-            order_items = db.session.query(OrderItem, Service)\
-                                  .join(Service, OrderItem.service_id == Service.id)\
-                                  .filter(OrderItem.order_id == order.id)\
-                                  .all()
-
-            orders_with_items.append({
-                'order': order,
-                'items': order_items
-            })
-
-        return render_template('my_orders.html', orders=orders_with_items)
+        include_archive = request.args.get('archive') == '1'
+        orders, next_cursor = load_order_history(current_user.id, request.args.get('cursor'),
+                                                 include_archive=include_archive)
+        return render_template('my_orders.html', orders=orders, next_cursor=next_cursor,
+                               cursor=request.args.get('cursor'), archive=include_archive)
 
     except Exception as e:
         app.logger.error(f'Ошибка при загрузке заказов пользователя {current_user.username}: {str(e)}')
         flash('Произошла ошибка при загрузке заказов', 'error')
-        return render_template('my_orders.html', orders=[])
+        return render_template('my_orders.html', orders=[], next_cursor=None, cursor=None)
 
 @app.route('/admin')
 @login_required
@@ -926,92 +3110,24 @@ def admin():
     """
     Панель администратора.
 
-    Отображает всю информацию для управления сайтом:
-    - Услуги, новости, портфолио, заказы
-    - Статистику по всем сущностям
+    Отдаёт только каркас страницы и статистику: строки разделов
+    (заказы, новости, услуги, портфолио) загружаются скриптом страницы
+    через /admin/api/<раздел> при открытии вкладки.
     """
     try:
         if not current_user.is_admin:
             app.logger.warning(f'Пользователь {current_user.username} попытался получить доступ к админ-панели')
             abort(403)
 
-        services = Service.query.order_by(Service.id.desc()).all()
-        news = News.query.order_by(News.date_posted.desc()).all()
-        portfolio_items = Portfolio.query.order_by(Portfolio.created_at.desc()).all()
-        orders = db.session.query(Order, User)\
-                         .join(User, Order.user_id == User.id)\
-                         .order_by(Order.date_created.desc())\
-                         .all()
-
-        services_list = []
-        for service in services:
-            services_list.append({
-                'id': service.id,
-                'title': service.title,
-                'description': service.description,
-                'price': float(service.price) if service.price else 0.0,
-                'category': service.category,
-                'image_url': service.image_url,
-                'created_at': service.created_at.strftime('%d.%m.%Y') if service.created_at else None
-            })
-
-        news_list = []
-        for news_item in news:
-            news_list.append({
-                'id': news_item.id,
-                'title': news_item.title,
-                'content': news_item.content,
-                'image_url': news_item.image_url,
-                'date_posted': news_item.date_posted.strftime('%d.%m.%Y %H:%M')
-            })
-
-        portfolio_list = []
-        for item in portfolio_items:
-            portfolio_list.append({
-                'id': item.id,
-                'title': item.title,
-                'category': item.category,
-                'image_url': item.image_url,
-                'event_type': item.event_type,
-                'created_at': item.created_at.strftime('%d.%m.%Y') if item.created_at else None
-            })
-
-        orders_list = []
-        for order, user in orders:
-            orders_list.append({
-                'id': order.id,
-                'status': order.status,
-                'total_amount': float(order.total_price),
-                'date_created': order.date_created.strftime('%d.%m.%Y %H:%M'),
-                'user_name': user.username if user else 'Неизвестный',
-                'user_email': user.email if user else 'Неизвестно'
-            })
+        active_tab = request.args.get('tab', 'orders')
+        if active_tab not in ADMIN_SECTIONS:
+            active_tab = 'orders'
 
-        total_services = Service.query.count()
-        total_news = News.query.count()
-        total_portfolio = Portfolio.query.count()
-        total_orders = Order.query.count()
-        new_orders = Order.query.filter_by(status='Новый').count()
-        total_users = User.query.count()
-
-        stats = {
-            'total_services': total_services,
-            'total_news': total_news,
-            'total_portfolio': total_portfolio,
-            'total_orders': total_orders,
-            'new_orders': new_orders,
-            'total_users': total_users
-        }
+        stats = get_admin_stats()
 
         return render_template('admin.html',
-                             services=services,
-                             news=news,
-                             portfolio_items=portfolio_items,
-                             orders=orders,
-                             services_list=services_list,
-                             news_list=news_list,
-                             portfolio_list=portfolio_list,
-                             orders_list=orders_list,
+                             active_tab=active_tab,
+                             order_statuses=ORDER_STATUSES,
                              stats=stats)
 
     except Exception as e:
@@ -1019,6 +3135,141 @@ def admin():
         flash('Произошла ошибка при загрузке админ-панели', 'error')
         return redirect(url_for('index'))
 
+@app.route('/admin/api/<section>')
+@login_required
+def admin_section_api(section):
+    """
+    Страница раздела админ-панели в формате JSON.
+
+    Принимает курсор ?cursor=... и возвращает строки и курсор следующей страницы.
+    """
+    if not current_user.is_admin:
+        return jsonify({'success': False, 'message': 'Недостаточно прав'}), 403
+
+    if section not in ADMIN_SECTIONS:
+        abort(404)
+
+    try:
+        rows_list, next_cursor = get_admin_section_page(section, request.args.get('cursor'))
+        return jsonify({'success': True, 'items': rows_list, 'next_cursor': next_cursor})
+    except Exception as e:
+        app.logger.error(f'Ошибка при загрузке раздела админ-панели {section}: {str(e)}')
+        return jsonify({'success': False, 'message': 'Произошла ошибка при загрузке данных'})
+
+@app.route('/admin/api/<section>/<int:id>')
+@login_required
+def admin_item_api(section, id):
+    """
+    Полная запись раздела админ-панели для формы редактирования.
+    """
+    if not current_user.is_admin:
+        return jsonify({'success': False, 'message': 'Недостаточно прав'}), 403
+
+    if section == 'services':
+        item = service_to_dict(Service.query.get_or_404(id))
+    elif section == 'news':
+        item = news_to_dict(News.query.get_or_404(id))
+    elif section == 'portfolio':
+        item = portfolio_to_dict(Portfolio.query.get_or_404(id))
+    else:
+        abort(404)
+
+    return jsonify({'success': True, 'item': item})
+
+@app.route('/admin/analytics')
+@login_required
+def admin_analytics():
+    """
+    Отчёт по выручке и спросу: по месяцам, категориям и услугам.
+
+    Читает только дневные сводки; перед чтением дописывает в них новые
+    заказы, если с прошлого обновления прошло ANALYTICS_REFRESH_INTERVAL.
+    Поддерживает JSON (?format=json) для внешних отчётов.
+    """
+    if not current_user.is_admin:
+        app.logger.warning(f'Пользователь {current_user.username} попытался открыть аналитику без прав')
+        abort(403)
+
+    period = get_analytics_period(request.args)
+
+    try:
+        ensure_analytics_fresh()
+    except Exception as e:
+        db.session.rollback()
+        app.logger.error(f'Ошибка при обновлении сводок аналитики: {str(e)}')
+
+    try:
+        report = get_analytics_report(period['date_from'], period['date_to'])
+    except Exception as e:
+        app.logger.error(f'Ошибка при построении отчёта аналитики: {str(e)}')
+        if wants_json():
+            return jsonify({'success': False, 'message': 'Произошла ошибка при построении отчёта'})
+        flash('Произошла ошибка при построении отчёта', 'error')
+        return redirect(url_for('admin'))
+
+    if wants_json():
+        return jsonify({'success': True, **report})
+
+    return render_template('analytics.html', report=report, period=period)
+
+@app.route('/admin/events')
+@login_required
+def admin_order_events():
+    """
+    SSE-поток событий заказов для админ-панели: order_created и order_status.
+
+    Данные события — строка таблицы заказов в формате /admin/api/orders.
+    Без заголовка Last-Event-ID поток начинается с текущего момента.
+    """
+    if not current_user.is_admin:
+        return jsonify({'success': False, 'message': 'Недостаточно прав'}), 403
+
+    last_id = request.headers.get('Last-Event-ID', type=int)
+    if last_id is None:
+        last_id = db.session.query(func.max(OrderEvent.id)).scalar() or 0
+        db.session.rollback()
+
+    response = Response(stream_with_context(stream_order_events(last_id)), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+@app.route('/admin/export/orders')
+@login_required
+def admin_export_orders():
+    """
+    Потоковая выгрузка заказов с позициями, услугами и email клиентов.
+
+    Параметры: format=csv|ndjson, date_from, date_to, status (можно несколько),
+    include_archive=1.
+    Ответ формируется генератором, поэтому память не зависит от числа заказов.
+    """
+    if not current_user.is_admin:
+        app.logger.warning(f'Пользователь {current_user.username} попытался выгрузить заказы без прав')
+        abort(403)
+
+    export_format = request.args.get('format', 'csv')
+    if export_format not in EXPORT_FORMATS:
+        return jsonify({'success': False, 'message': 'Неверный формат выгрузки'}), 400
+
+    try:
+        filters = parse_export_filters(request.args)
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+
+    app.logger.info(f'Администратор {current_user.username} выгрузил заказы ({export_format}): {request.args.to_dict(flat=False)}')
+
+    if export_format == 'csv':
+        body, mimetype = generate_orders_csv(filters), 'text/csv'
+    else:
+        body, mimetype = generate_orders_ndjson(filters), 'application/x-ndjson'
+
+    filename = f'orders_{datetime.now().strftime("%Y%m%d_%H%M")}.{export_format}'
+    response = Response(stream_with_context(body), mimetype=mimetype)
+    response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+    response.headers['Cache-Control'] = 'private, no-store'
+    return response
+
 @app.route('/admin/service/add', methods=['POST'])
 @login_required
 def admin_add_service():
@@ -1059,6 +3310,8 @@ def admin_add_service():
             errors.append('Неверная категория')
 
         if errors:
+            if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
+                return jsonify({'success': False, 'message': '<br>'.join(errors)})
             for error in errors:
                 flash(error, 'error')
             return redirect(url_for('admin'))
@@ -1072,15 +3325,21 @@ def admin_add_service():
         )
 
         db.session.add(service)
+        db.session.flush()
+        index_search_document('service', service.id, service.title, service.description)
+        bump_stat('total_services')
         db.session.commit()
+        invalidate_catalog()
+        response_cache.invalidate('services')
 
-        flash(f'Услуга "{title}" успешно добавлена!', 'success')
         app.logger.info(f'Администратор {current_user.username} добавил услугу: {title}')
 
         if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
-            return jsonify({'success': True, 'message': f'Услуга "{title}" успешно добавлена!'})
+            return jsonify({'success': True, 'message': f'Услуга "{title}" успешно добавлена!',
+                            'item': get_admin_row('services', service.id)})
 
-        return redirect(url_for('admin'))
+        flash(f'Услуга "{title}" успешно добавлена!', 'success')
+        return redirect(url_for('admin', tab='services'))
 
     except Exception as e:
         db.session.rollback()
@@ -1132,6 +3391,8 @@ def admin_edit_service(id):
             errors.append('Неверная категория')
 
         if errors:
+            if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
+                return jsonify({'success': False, 'message': '<br>'.join(errors)})
             for error in errors:
                 flash(error, 'error')
             return redirect(url_for('admin'))
@@ -1142,15 +3403,19 @@ def admin_edit_service(id):
         service.category = category
         service.image_url = image_url or None
 
+        index_search_document('service', service.id, service.title, service.description)
         db.session.commit()
+        invalidate_catalog()
+        response_cache.invalidate('services')
 
-        flash(f'Услуга "{title}" успешно обновлена!', 'success')
         app.logger.info(f'Администратор {current_user.username} обновил услугу ID {id}: {title}')
 
         if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
-            return jsonify({'success': True, 'message': f'Услуга "{title}" успешно обновлена!'})
+            return jsonify({'success': True, 'message': f'Услуга "{title}" успешно обновлена!',
+                            'item': get_admin_row('services', id)})
 
-        return redirect(url_for('admin'))
+        flash(f'Услуга "{title}" успешно обновлена!', 'success')
+        return redirect(url_for('admin', tab='services'))
 
     except Exception as e:
         db.session.rollback()
@@ -1176,23 +3441,31 @@ def admin_delete_service(id):
 
         service = Service.query.get_or_404(id)
 
-        order_items = OrderItem.query.filter_by(service_id=id).first()
+        order_items = OrderItem.query.filter_by(service_id=id).first() or \
+            ArchivedOrderItem.query.filter_by(service_id=id).first()
         if order_items:
-            flash('Нельзя удалить услугу, так как она используется в заказах', 'error')
+            error_message = 'Нельзя удалить услугу, так как она используется в заказах'
+            if request.headers.get('X-Requested-With') == 'XMLHttpRequest' or request.is_json:
+                return jsonify({'success': False, 'message': error_message})
+            flash(error_message, 'error')
             return redirect(url_for('admin'))
 
         service_title = service.title
 
         db.session.delete(service)
+        remove_search_document('service', id)
+        bump_stat('total_services', -1)
         db.session.commit()
+        invalidate_catalog()
+        response_cache.invalidate('services')
 
-        flash(f'Услуга "{service_title}" успешно удалена!', 'success')
         app.logger.info(f'Администратор {current_user.username} удалил услугу ID {id}: {service_title}')
 
         if request.headers.get('X-Requested-With') == 'XMLHttpRequest' or request.is_json:
-            return jsonify({'success': True, 'message': f'Услуга "{service_title}" успешно удалена!'})
+            return jsonify({'success': True, 'message': f'Услуга "{service_title}" успешно удалена!', 'id': id})
         else:
-            return redirect(url_for('admin'))
+            flash(f'Услуга "{service_title}" успешно удалена!', 'success')
+            return redirect(url_for('admin', tab='services'))
 
     except Exception as e:
         db.session.rollback()
@@ -1239,16 +3512,21 @@ def admin_add_news():
         )
 
         db.session.add(news)
+        db.session.flush()
+        index_search_document('news', news.id, news.title, news.content)
+        bump_stat('total_news')
         db.session.commit()
+        response_cache.invalidate('news')
 
         success_message = f'Новость "{title}" успешно добавлена!'
         app.logger.info(f'Администратор {current_user.username} добавил новость: {title}')
 
         if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
-            return jsonify({'success': True, 'message': success_message})
+            return jsonify({'success': True, 'message': success_message,
+                            'item': get_admin_row('news', news.id)})
 
         flash(success_message, 'success')
-        return redirect(url_for('admin'))
+        return redirect(url_for('admin', tab='news'))
 
     except Exception as e:
         db.session.rollback()
@@ -1295,16 +3573,19 @@ def admin_edit_news(id):
         news.content = content
         news.image_url = image_url or None
 
+        index_search_document('news', news.id, news.title, news.content)
         db.session.commit()
+        response_cache.invalidate('news')
 
         success_message = f'Новость "{title}" успешно обновлена!'
         app.logger.info(f'Администратор {current_user.username} обновил новость ID {id}: {title}')
 
         if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
-            return jsonify({'success': True, 'message': success_message})
+            return jsonify({'success': True, 'message': success_message,
+                            'item': get_admin_row('news', id)})
 
         flash(success_message, 'success')
-        return redirect(url_for('admin'))
+        return redirect(url_for('admin', tab='news'))
 
     except Exception as e:
         db.session.rollback()
@@ -1333,15 +3614,18 @@ def admin_delete_news(id):
         news_title = news.title
 
         db.session.delete(news)
+        remove_search_document('news', id)
+        bump_stat('total_news', -1)
         db.session.commit()
+        response_cache.invalidate('news')
 
-        flash(f'Новость "{news_title}" успешно удалена!', 'success')
         app.logger.info(f'Администратор {current_user.username} удалил новость ID {id}: {news_title}')
 
         if request.headers.get('X-Requested-With') == 'XMLHttpRequest' or request.is_json:
-            return jsonify({'success': True, 'message': f'Новость "{news_title}" успешно удалена!'})
+            return jsonify({'success': True, 'message': f'Новость "{news_title}" успешно удалена!', 'id': id})
         else:
-            return redirect(url_for('admin'))
+            flash(f'Новость "{news_title}" успешно удалена!', 'success')
+            return redirect(url_for('admin', tab='news'))
 
     except Exception as e:
         db.session.rollback()
@@ -1371,22 +3655,36 @@ def admin_update_order_status(id):
         else:
             new_status = request.form.get('status', '').strip()
 
-        valid_statuses = ['Новый', 'В обработке', 'Подтвержден', 'Выполнен', 'Отменен', 'Завершен']
-        if new_status not in valid_statuses:
+        if new_status not in ORDER_STATUSES:
+            if request.headers.get('X-Requested-With') == 'XMLHttpRequest' or request.is_json:
+                return jsonify({'success': False, 'message': 'Неверный статус заказа'})
             flash('Неверный статус заказа', 'error')
             return redirect(url_for('admin'))
 
         old_status = order.status
         order.status = new_status
 
+        if old_status != new_status and 'Новый' in (old_status, new_status):
+            bump_stat('new_orders', 1 if new_status == 'Новый' else -1)
+        if (old_status in ANALYTICS_EXCLUDED_STATUSES) != (new_status in ANALYTICS_EXCLUDED_STATUSES):
+            mark_analytics_dirty(order.date_created)
+
+        event_date = order.event_date
+        db.session.flush()
+        item = get_admin_row('orders', id)
+        if old_status != new_status:
+            record_order_event('order_status', id, item)
         db.session.commit()
+        invalidate_bookings(event_date)
+        order_event_broker.notify()
 
-        flash(f'Статус заказа #{id} изменен с "{old_status}" на "{new_status}"', 'success')
         app.logger.info(f'Администратор {current_user.username} изменил статус заказа {id}: {old_status} -> {new_status}')
 
         if request.headers.get('X-Requested-With') == 'XMLHttpRequest' or request.is_json:
-            return jsonify({'success': True, 'message': f'Статус заказа #{id} изменен на "{new_status}"'})
+            return jsonify({'success': True, 'message': f'Статус заказа #{id} изменен на "{new_status}"',
+                            'item': item})
         else:
+            flash(f'Статус заказа #{id} изменен с "{old_status}" на "{new_status}"', 'success')
             return redirect(url_for('admin'))
 
     except Exception as e:
@@ -1398,6 +3696,97 @@ def admin_update_order_status(id):
             flash('Произошла ошибка при обновлении статуса заказа', 'error')
             return redirect(url_for('admin'))
 
+@app.route('/admin/orders/status', methods=['POST'])
+@login_required
+def admin_bulk_update_order_status():
+    """
+    Массовая смена статуса заказов.
+
+    Принимает JSON {"ids": [...], "status": "..."} и меняет статус одним
+    UPDATE в одной транзакции. Возвращает результат по каждому ID
+    (updated, unchanged, not_found) и обновлённые строки таблицы заказов.
+    """
+    if not current_user.is_admin:
+        app.logger.warning(f'Пользователь {current_user.username} попытался массово обновить статусы заказов без прав')
+        return jsonify({'success': False, 'message': 'Недостаточно прав'}), 403
+
+    data = request.get_json(silent=True) or {}
+    new_status = str(data.get('status', '')).strip()
+    ids = data.get('ids')
+
+    if new_status not in ORDER_STATUSES:
+        return jsonify({'success': False, 'message': 'Неверный статус заказа'}), 400
+    if not isinstance(ids, list) or not ids:
+        return jsonify({'success': False, 'message': 'Не выбраны заказы'}), 400
+    try:
+        ids = list(dict.fromkeys(int(order_id) for order_id in ids))
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'message': 'Неверный список заказов'}), 400
+    if len(ids) > BULK_STATUS_MAX_ORDERS:
+        return jsonify({'success': False, 'message': f'Можно изменить не более {BULK_STATUS_MAX_ORDERS} заказов за раз'}), 400
+
+    try:
+        # Старые статусы читаются под блокировкой: параллельная смена статуса
+        # не должна исказить new_orders, аналитику и результаты по ID.
+        begin_write_transaction()
+        rows = db.session.query(Order.id, Order.status, Order.event_date, Order.date_created)\
+                         .filter(Order.id.in_(ids))\
+                         .order_by(Order.id)\
+                         .with_for_update()\
+                         .all()
+        current = {order_id: status for order_id, status, _, _ in rows}
+        changed = [order_id for order_id in ids if order_id in current and current[order_id] != new_status]
+        items = []
+
+        if changed:
+            Order.query.filter(Order.id.in_(changed))\
+                       .update({Order.status: new_status}, synchronize_session=False)
+
+            if new_status == 'Новый':
+                bump_stat('new_orders', len(changed))
+            else:
+                left_new = sum(1 for order_id in changed if current[order_id] == 'Новый')
+                if left_new:
+                    bump_stat('new_orders', -left_new)
+
+            mark_analytics_dirty(*(
+                date_created for order_id, status, _, date_created in rows
+                if order_id in changed
+                and (status in ANALYTICS_EXCLUDED_STATUSES) != (new_status in ANALYTICS_EXCLUDED_STATUSES)
+            ))
+
+            items = [admin_row_to_dict('orders', row)
+                     for row in admin_list_query('orders').filter(Order.id.in_(changed)).all()]
+            for item in items:
+                record_order_event('order_status', item['id'], item)
+
+        db.session.commit()
+        invalidate_bookings(*{event_date for order_id, _, event_date, _ in rows if order_id in changed})
+        order_event_broker.notify()
+
+    except Exception as e:
+        db.session.rollback()
+        app.logger.error(f'Ошибка при массовом обновлении статусов заказов: {str(e)}')
+        return jsonify({'success': False, 'message': 'Произошла ошибка при обновлении статусов заказов'}), 500
+
+    results = {}
+    for order_id in ids:
+        if order_id not in current:
+            results[order_id] = 'not_found'
+        elif order_id in changed:
+            results[order_id] = 'updated'
+        else:
+            results[order_id] = 'unchanged'
+
+    app.logger.info(f'Администратор {current_user.username} изменил статус {len(changed)} заказов на "{new_status}": {changed}')
+
+    return jsonify({
+        'success': True,
+        'message': f'Статус "{new_status}" установлен для {len(changed)} из {len(ids)} заказов',
+        'results': results,
+        'items': items
+    })
+
 @app.route('/admin/order/delete/<int:id>', methods=['POST'])
 @login_required
 def admin_delete_order(id):
@@ -1411,15 +3800,21 @@ def admin_delete_order(id):
 
         order = Order.query.get_or_404(id)
 
+        event_date = order.event_date
         db.session.delete(order)
+        bump_stat('total_orders', -1)
+        mark_analytics_dirty(order.date_created)
+        if order.status == 'Новый':
+            bump_stat('new_orders', -1)
         db.session.commit()
+        invalidate_bookings(event_date)
 
-        flash(f'Заказ #{id} успешно удален!', 'success')
         app.logger.info(f'Администратор {current_user.username} удалил заказ ID {id}')
 
         if request.headers.get('X-Requested-With') == 'XMLHttpRequest' or request.is_json:
-            return jsonify({'success': True, 'message': f'Заказ #{id} успешно удален!'})
+            return jsonify({'success': True, 'message': f'Заказ #{id} успешно удален!', 'id': id})
         else:
+            flash(f'Заказ #{id} успешно удален!', 'success')
             return redirect(url_for('admin'))
 
     except Exception as e:
@@ -1459,12 +3854,16 @@ def admin_portfolio_add():
             image_url=image_url
         )
         db.session.add(portfolio_item)
+        db.session.flush()
+        index_search_document('portfolio', portfolio_item.id, portfolio_item.title, portfolio_item.event_type)
+        bump_stat('total_portfolio')
         db.session.commit()
+        response_cache.invalidate('portfolio')
 
-        flash('Работа успешно добавлена в портфолио!', 'success')
         app.logger.info(f'Администратор {current_user.username} добавил работу в портфолио: {title}')
 
-        return jsonify({'success': True, 'message': 'Работа успешно добавлена в портфолио!'})
+        return jsonify({'success': True, 'message': 'Работа успешно добавлена в портфолио!',
+                        'item': get_admin_row('portfolio', portfolio_item.id)})
 
     except Exception as e:
         db.session.rollback()
@@ -1499,12 +3898,14 @@ def admin_portfolio_edit(id):
         portfolio_item.category = category
         portfolio_item.event_type = event_type
         portfolio_item.image_url = image_url
+        index_search_document('portfolio', portfolio_item.id, portfolio_item.title, portfolio_item.event_type)
         db.session.commit()
+        response_cache.invalidate('portfolio')
 
-        flash('Работа успешно обновлена!', 'success')
         app.logger.info(f'Администратор {current_user.username} редактировал работу портфолио ID {id}')
 
-        return jsonify({'success': True, 'message': 'Работа успешно обновлена!'})
+        return jsonify({'success': True, 'message': 'Работа успешно обновлена!',
+                        'item': get_admin_row('portfolio', id)})
 
     except Exception as e:
         db.session.rollback()
@@ -1525,18 +3926,71 @@ def admin_portfolio_delete(id):
         portfolio_item = Portfolio.query.get_or_404(id)
 
         db.session.delete(portfolio_item)
+        remove_search_document('portfolio', id)
+        bump_stat('total_portfolio', -1)
         db.session.commit()
+        response_cache.invalidate('portfolio')
 
-        flash('Работа успешно удалена из портфолио!', 'success')
         app.logger.info(f'Администратор {current_user.username} удалил работу портфолио ID {id}')
 
-        return jsonify({'success': True, 'message': 'Работа успешно удалена из портфолио!'})
+        return jsonify({'success': True, 'message': 'Работа успешно удалена из портфолио!', 'id': id})
 
     except Exception as e:
         db.session.rollback()
         app.logger.error(f'Ошибка при удалении работы портфолио {id}: {str(e)}')
         return jsonify({'success': False, 'message': 'Произошла ошибка при удалении'})
 
+@app.cli.command('reconcile-stats')
+def reconcile_stats_command():
+    """
+    Сверка счётчиков статистики с таблицами (для запуска по расписанию).
+    """
+    init_database()
+    fixed = reconcile_stats()
+    print(f'Статистика сверена, исправлено счётчиков: {len(fixed)}')
+
+@app.cli.command('refresh-analytics')
+@click.option('--full', is_flag=True, help='Пересобрать сводки по всем заказам.')
+def refresh_analytics_command(full):
+    """
+    Обновление дневных сводок аналитики (для запуска по расписанию).
+    """
+    init_database()
+    processed = refresh_analytics(full=full)
+    print(f'Сводки аналитики обновлены, учтено заказов: {processed}')
+
+@app.cli.command('migrate')
+def migrate_command():
+    """
+    Применение миграций схемы и вывод их состояния.
+    """
+    db.create_all()
+    done = run_migrations()
+    print(f'Применено миграций: {len(done)}')
+    for migration_row in SchemaMigration.query.order_by(SchemaMigration.version):
+        print(f'{migration_row.version:>4}  {migration_row.applied_at:%Y-%m-%d %H:%M}  {migration_row.name}')
+
+@app.cli.command('archive-orders')
+@click.option('--days', type=int, default=None, help='Возраст заказа в днях (по умолчанию ORDER_ARCHIVE_AFTER_DAYS).')
+@click.option('--batch-size', default=ARCHIVE_BATCH_SIZE, show_default=True, help='Заказов в одной транзакции.')
+def archive_orders_command(days, batch_size):
+    """
+    Перенос старых выполненных и отменённых заказов в архив (для запуска по расписанию).
+    """
+    init_database()
+    moved = archive_orders(days, batch_size)
+    print(f'Архивирование завершено, перенесено заказов: {moved}')
+
+@app.cli.command('prune-order-events')
+@click.option('--days', default=ORDER_EVENTS_RETENTION_DAYS, show_default=True, help='Сколько дней хранить события.')
+def prune_order_events_command(days):
+    """
+    Очистка журнала событий заказов от старых записей (для запуска по расписанию).
+    """
+    init_database()
+    removed = prune_order_events(days)
+    print(f'Журнал событий заказов очищен, удалено записей: {removed}')
+
 @app.errorhandler(404)
 def page_not_found(e):
     """
@@ -1681,9 +4135,14 @@ if __name__ == '__main__':
     with app.app_context():
         try:
             db.create_all()
+            run_migrations()
             print("Таблицы базы данных созданы/проверены")
 
             create_dummy_data()
+            reconcile_stats()
+
+            ensure_search_index()
+            print("Поисковый индекс проверен")
 
         except Exception as e:
             print(f"Ошибка при инициализации базы данных: {str(e)}")